@@ -1,4 +1,6 @@
 from .pvector import pvector
+from .pvector import VersionHistory
 from .pvector import v
+from .pvector import from_numpy
 from .pmap import pmap
 from .plist import plist
\ No newline at end of file
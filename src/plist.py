@@ -1,5 +1,120 @@
+from itertools import count
 from numbers import Integral
+import functools
+import threading
 
+from .pvector import _hash_sequence
+
+
+class OrderMarker(object):
+    """
+        Element of order-maintenance list (Dietz-Sleator): markers are compared by labels
+    """
+    __slots__ = ('label', 'prev', 'next')
+
+    # пространство меток, хвостовой маркер списка имеет метку LABEL_SPACE
+    LABEL_BITS = 62
+    LABEL_SPACE = 1 << LABEL_BITS
+    # порог плотности при перераспределении меток, 1 < DENSITY < 2
+    DENSITY = 1.25
+
+    def __new__(cls, label, prev, next):
+        self = super(OrderMarker, cls).__new__(cls)
+        self.label = label
+        self.prev = prev
+        self.next = next
+        return self
+
+
+class VersionOrder(object):
+    """
+        Order-maintenance list of one version tree.
+
+        Writers of the family are serialized by lock. Relabeling bumps epoch before and after
+        (odd epoch - relabeling in progress), readers retry comparisons if epoch changed
+    """
+    __slots__ = ('head', 'lock', 'epoch')
+
+    def __new__(cls):
+        self = super(VersionOrder, cls).__new__(cls)
+        self.head = OrderMarker(0, None, None)
+        self.head.next = OrderMarker(OrderMarker.LABEL_SPACE, self.head, None)
+        self.lock = threading.Lock()
+        self.epoch = 0
+        return self
+
+    def _relabel_around(self, marker):
+        """
+            Раздвигаем метки вокруг marker (Bender et al.): ищем наименьший выровненный диапазон
+            меток размера 2^i, в котором маркеров меньше (2 / T)^i, и равномерно распределяем их в нем
+            (амортизированно O(log^2 n) на вставку)
+        """
+        if marker.prev is None:
+            # головной маркер не двигаем, раздвигаем метки после него
+            marker = marker.next
+
+        left = right = marker
+        count = 1
+
+        for i in range(1, OrderMarker.LABEL_BITS + 1):
+            size = 1 << i
+            low = marker.label & ~(size - 1)
+            high = low + size
+
+            # головной и хвостовой маркеры не двигаем
+            while left.prev is not None and left.prev.prev is not None and left.prev.label >= low:
+                left = left.prev
+                count += 1
+            while right.next.next is not None and right.next.label < high:
+                right = right.next
+                count += 1
+
+            if count < (2 / OrderMarker.DENSITY) ** i and 2 * (count + 1) <= size:
+                step = size // (count + 1)
+                node = left
+                label = low + step
+                self.epoch += 1
+                while True:
+                    node.label = label
+                    if node is right:
+                        break
+                    node = node.next
+                    label += step
+                self.epoch += 1
+                return
+
+        assert False, "Order labels are exhausted"
+
+    def insert_after(self, marker):
+        """ Новый маркер сразу после marker """
+
+        if marker.next.label - marker.label < 2:
+            self._relabel_around(marker)
+
+        nxt = marker.next
+        new_marker = OrderMarker((marker.label + nxt.label) // 2, marker, nxt)
+        marker.next = new_marker
+        nxt.prev = new_marker
+        return new_marker
+
+
+# источник номеров версий: next() у itertools.count атомарен (выполняется под GIL)
+_version_counter = count(1)
+
+
+def _next_version():
+    return next(_version_counter)
+
+
+def _write_locked(method):
+    """ Писатели одного семейства версий PList сериализуются, читатели работают без блокировок """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._root_version.order.lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
 
 
 class ListFatNode(object):
@@ -16,26 +131,41 @@ class ListFatNode(object):
         self.nodes.append(node)
 
     def find_node(self, version_node):
+        # нода видна в версии, если ее версия - предок version_node (вложенный интервал Эйлерова обхода),
+        # из таких берем самую глубокую - с наибольшей меткой входа
+        order = version_node.order
 
-        it = version_node
+        while True:
+            epoch = order.epoch
+            label = version_node.enter.label
+            found = None
+            found_label = -1
 
-        while it is not None:
-            any_nodes = list(filter(lambda n: n.version == it.version, self.nodes))
+            for n in self.nodes:
+                enter_label = n.version.enter.label
+                if enter_label <= label < n.version.leave.label and enter_label > found_label:
+                    found = n
+                    found_label = enter_label
 
-            if any_nodes:
-                return any_nodes[0]
-            else:
-                it = it.parent
+            # метки не переписывались во время сравнения
+            if not epoch & 1 and epoch == order.epoch:
+                break
 
-        assert False, "Unreached version"
+        assert found is not None, "Unreached version"
+        return found
 
     def is_full(self):
         return len(self.nodes) == ListFatNode.MAX_SIZE
 
     def update_right(self, right_node, version_node):
         node = self.find_node(version_node)
+        if node.version is version_node:
+            # нода создана в этой же версии и еще нигде не видна - меняем на месте
+            node.right_node = right_node
+            return self
+
         new_node = node.copy()
-        new_node.version = version_node.version
+        new_node.version = version_node
 
         new_node.right_node = right_node
 
@@ -57,8 +187,12 @@ class ListFatNode(object):
     def update_left(self, left_node, version_node):
 
         node = self.find_node(version_node)
+        if node.version is version_node:
+            node.left_node = left_node
+            return self
+
         new_node = node.copy()
-        new_node.version = version_node.version
+        new_node.version = version_node
 
         new_node.left_node = left_node
 
@@ -82,6 +216,7 @@ class ListFatNode(object):
 
 
 class ListNode(object):
+    # version - VersionNode, в которой нода создана
     __slots__ = ('left_node', 'right_node', 'value', 'version', '__weakref__', '_cached_hash')
 
     def __new__(cls, left_node, right_node, value, version):
@@ -100,11 +235,41 @@ class ListNode(object):
                              )
 
 
+def _link_nodes(values, version_node):
+    """
+        Chain of new fat nodes with values, all nodes belong to version_node.
+        Returns (first, last) fat nodes, (None, None) for no values
+    """
+    first = prev = None
+    for value in values:
+        fat_node = ListFatNode()
+        fat_node.add(ListNode(prev, None, value, version_node))
+        if prev is None:
+            first = fat_node
+        else:
+            prev.nodes[0].right_node = fat_node
+        prev = fat_node
+
+    return first, prev
+
+
 class VersionNode(object):
-    __slots__ = ('version', 'child', 'parent', 'front', 'back', '__weakref__', '_cached_hash')
+    __slots__ = ('version', 'child', 'parent', 'front', 'back', 'size', 'order', 'enter', 'leave',
+                 '__weakref__', '_cached_hash')
 
-    def __new__(cls, front, back, parent, child, version):
+    def __new__(cls, front, back, parent, child, version, size):
         self = super(VersionNode, cls).__new__(cls)
+        # метки входа/выхода Эйлерова обхода дерева версий: потомок вкладывается в интервал родителя,
+        # проверка "версия - предок" - два сравнения меток
+        if parent is None:
+            self.order = VersionOrder()
+            self.enter = self.order.insert_after(self.order.head)
+        else:
+            self.order = parent.order
+            self.enter = self.order.insert_after(parent.enter)
+        self.leave = self.order.insert_after(self.enter)
+        # кол-во элементов в версии
+        self.size = size
         self.back = back
         self.front = front
         self.parent = parent
@@ -112,6 +277,21 @@ class VersionNode(object):
         self.version = version
         return self
 
+def _plist_hash(l):
+    # хеш как у tuple с теми же элементами, версия неизменяема - считаем один раз
+    if not hasattr(l, '_cached_hash'):
+        l._cached_hash = _hash_sequence(l, len(l))
+    return l._cached_hash
+
+
+def _plist_equal(l, other):
+    if len(l) != len(other):
+        return False
+    if hasattr(l, '_cached_hash') and hasattr(other, '_cached_hash') and l._cached_hash != other._cached_hash:
+        return False
+    return all(x is y or x == y for x, y in zip(l, other))
+
+
 class PListIter(object):
 
     def __init__(self, plist):
@@ -130,18 +310,33 @@ class PListIter(object):
         return self._pos.value
 
 class PList(object):
+    """
+        Persistent doubly linked list on fat nodes.
 
-    __slots__ = ('_root_version', '__weakref__', '_cached_hash')
+        Thread safety: versions may be shared between threads. Reads (iteration, indexing, len)
+        take no locks. Writes append to fat nodes shared by the whole version family, so writers
+        of one family are serialized by its VersionOrder lock. Version numbers come from an
+        atomic counter
+    """
 
-    GLOBAL_VERSION = 0
+    __slots__ = ('_root_version', '__weakref__', '_cached_hash')
 
     def __init__(self, version_node=None):
 
         if version_node:
             self._root_version = version_node
         else:
-            PList.GLOBAL_VERSION += 1
-            self._root_version = VersionNode(None, None, None, None, PList.GLOBAL_VERSION)
+            self._root_version = VersionNode(None, None, None, None, _next_version(), 0)
+
+    @classmethod
+    def from_iterable(cls, iterable):
+        """
+            Build plist in one pass: an empty root version and one version with all values,
+            as after repeated append_back
+        """
+        values = list(iterable)
+        l = cls()
+        return l._build(values) if values else l
 
     def __str__(self):
         return str(self.tolist())
@@ -149,6 +344,17 @@ class PList(object):
     def __iter__(self):
         return PListIter(self)
 
+    def __hash__(self):
+        return _plist_hash(self)
+
+    def __eq__(self, other):
+        if not isinstance(other, (PList, TreePList)):
+            return NotImplemented
+        # одна и та же версия
+        if self is other or (type(other) is PList and self._root_version is other._root_version):
+            return True
+        return _plist_equal(self, other)
+
     def undo(self):
         if self._root_version.parent is None:
             return None
@@ -172,20 +378,22 @@ class PList(object):
         return py_list
 
     def __len__(self):
-        return len(self.tolist())
+        return self._root_version.size
 
+    @_write_locked
     def remove(self, index):
         if not isinstance(index, int):
             raise TypeError("'%s' object cannot be interpreted as an index" % type(index).__name__)
-        assert index >= 0 and index < len(self)
+        size = len(self)
+        assert index >= 0 and index < size
 
         if index < 0:
-            index += len(self)
+            index += size
 
-        if not (0 <= index < len(self)):
-            raise ValueError("Bad index for list with length '%s' " % len(self))
+        if not (0 <= index < size):
+            raise ValueError("Bad index for list with length '%s' " % size)
 
-        PList.GLOBAL_VERSION += 1
+        version = _next_version()
 
         it = self._root_version.front
 
@@ -195,7 +403,7 @@ class PList(object):
         node_to_del = it.find_node(self._root_version)
 
         new_v = VersionNode(self._root_version.front, self._root_version.back, self._root_version, None,
-                            PList.GLOBAL_VERSION)
+                            version, size - 1)
 
         if node_to_del.right_node is None and node_to_del.left_node is None:
             new_v.front = None
@@ -239,17 +447,18 @@ class PList(object):
         return PList(new_v)
 
 
+    @_write_locked
     def insert(self, index, value):
         if not isinstance(index, int):
             raise TypeError("'%s' object cannot be interpreted as an index" % type(index).__name__)
         assert index >= 0 and index <= len(self)
-        PList.GLOBAL_VERSION += 1
+        version = _next_version()
 
-        new_n = ListNode(None, None, value, PList.GLOBAL_VERSION)
+        new_v = VersionNode(self._root_version.front, self._root_version.back, self._root_version, None,
+                            version, self._root_version.size + 1)
+        new_n = ListNode(None, None, value, new_v)
         new_f = ListFatNode()
         new_f.add(new_n)
-        new_v = VersionNode(self._root_version.front, self._root_version.back, self._root_version, None,
-                            PList.GLOBAL_VERSION)
 
         front = self._root_version.front
         if front is None:
@@ -282,8 +491,6 @@ class PList(object):
             raise TypeError("'%s' object cannot be interpreted as an index" % type(item).__name__)
         assert 0 <= item < len(self)
 
-        PList.GLOBAL_VERSION += 1
-
         front = self._root_version.front
 
         it = front
@@ -295,11 +502,12 @@ class PList(object):
 
         return found_node.value
 
+    @_write_locked
     def set(self, index, value):
         if not isinstance(index, int):
             raise TypeError("'%s' object cannot be interpreted as an index" % type(index).__name__)
         assert index >= 0 and index < len(self)
-        PList.GLOBAL_VERSION += 1
+        version = _next_version()
 
         front = self._root_version.front
 
@@ -311,9 +519,10 @@ class PList(object):
         found_node = it.find_node(self._root_version)
         new_n = found_node.copy()
 
-        new_v = VersionNode(self._root_version.front, self._root_version.back, self._root_version, None, PList.GLOBAL_VERSION)
+        new_v = VersionNode(self._root_version.front, self._root_version.back, self._root_version, None, version,
+                            self._root_version.size)
         new_n.value = value
-        new_n.version = PList.GLOBAL_VERSION
+        new_n.version = new_v
 
         if it.is_full():
             new_f = ListFatNode()
@@ -334,41 +543,189 @@ class PList(object):
         return PList(new_v)
 
     def append_back_list(self, list):
-        l = self
-        for x in list:
-            l = l.append_back(x)
-        return l
+        return self.evolver().extend(list).persistent()
 
-    def append_back(self, value):
+    @_write_locked
+    def _append_many(self, front_values, back_values):
+        """ One new version with values added at the front and at the back """
+
+        root = self._root_version
+        if root.front is None:
+            return self._build(list(front_values) + list(back_values))
+
+        new_v = VersionNode(root.front, root.back, root, None, _next_version(),
+                            root.size + len(front_values) + len(back_values))
+        root.child = new_v
+
+        if back_values:
+            first, last = _link_nodes(back_values, new_v)
+            first.nodes[0].left_node = new_v.back.update_right(first, new_v)
+            new_v.back = last
+
+        if front_values:
+            # front мог смениться при копировании нод справа налево
+            first, last = _link_nodes(front_values, new_v)
+            last.nodes[0].right_node = new_v.front.update_left(last, new_v)
+            new_v.front = first
+
+        return PList(new_v)
+
+    @_write_locked
+    def _rebuild(self, values):
+        return self._build(values)
+
+    def _build(self, values):
+        """ One new version holding values, nodes are not shared with the parent version """
+
+        root = self._root_version
+        new_v = VersionNode(None, None, root, None, _next_version(), len(values))
+        root.child = new_v
+        new_v.front, new_v.back = _link_nodes(values, new_v)
+        return PList(new_v)
+
+    class _Evolver(object):
+        """
+            Batch of edits applied under one new version by persistent().
+
+            Appends at the ends are linked to the original list, any other edit
+            materializes the list and persistent() relinks it
+        """
+        __slots__ = ('_plist', '_values', '_front', '_back')
+
+        def __init__(self, original_plist):
+            self._reset(original_plist)
+
+        def _reset(self, original_plist):
+            self._plist = original_plist
+            # все элементы, None пока были только добавления в концы
+            self._values = None
+            # добавленные в начало, в порядке добавления
+            self._front = []
+            self._back = []
+
+        def _materialize(self):
+            if self._values is None:
+                self._values = self._front[::-1] + self._plist.tolist() + self._back
+                self._front = []
+                self._back = []
+            return self._values
+
+        def _check_index(self, index, upper):
+            if not isinstance(index, int):
+                raise TypeError("'%s' object cannot be interpreted as an index" % type(index).__name__)
+            assert 0 <= index < upper
+
+        def __len__(self):
+            if self._values is not None:
+                return len(self._values)
+            return len(self._front) + len(self._plist) + len(self._back)
+
+        def __getitem__(self, index):
+            self._check_index(index, len(self))
+            if self._values is not None:
+                return self._values[index]
+
+            if index < len(self._front):
+                return self._front[-1 - index]
+            index -= len(self._front)
+            if index < len(self._plist):
+                return self._plist[index]
+            return self._back[index - len(self._plist)]
+
+        def __setitem__(self, index, value):
+            self.set(index, value)
+
+        def append_back(self, value):
+            if self._values is not None:
+                self._values.append(value)
+            else:
+                self._back.append(value)
+            return self
+
+        def append_front(self, value):
+            if self._values is not None:
+                self._values.insert(0, value)
+            else:
+                self._front.append(value)
+            return self
 
-        PList.GLOBAL_VERSION += 1
+        def extend(self, values):
+            if self._values is not None:
+                self._values.extend(values)
+            else:
+                self._back.extend(values)
+            return self
+
+        def set(self, index, value):
+            self._check_index(index, len(self))
+            self._materialize()[index] = value
+            return self
+
+        def insert(self, index, value):
+            self._check_index(index, len(self) + 1)
+            self._materialize().insert(index, value)
+            return self
+
+        def remove(self, index):
+            self._check_index(index, len(self))
+            del self._materialize()[index]
+            return self
+
+        def is_dirty(self):
+            """
+                Check evolver for modifications
+            """
+            return self._values is not None or bool(self._front or self._back)
+
+        def persistent(self):
+            """
+                Create plist with all edits as one new version
+            """
+            if not self.is_dirty():
+                return self._plist
+
+            if self._values is None:
+                result = self._plist._append_many(self._front[::-1], self._back)
+            else:
+                result = self._plist._rebuild(self._values)
+            self._reset(result)
+            return result
+
+    def evolver(self):
+        return PList._Evolver(self)
+
+    @_write_locked
+    def append_back(self, value):
 
         if self._root_version.back is None:
             return self._init_root(value)
 
-        new_n = ListNode(None, None, value, PList.GLOBAL_VERSION)
+        version = _next_version()
+
         new_f = ListFatNode()
+        new_v = VersionNode(self._root_version.front, new_f, self._root_version, None, version,
+                            self._root_version.size + 1)
+        new_n = ListNode(None, None, value, new_v)
         new_f.add(new_n)
-
-        new_v = VersionNode(self._root_version.front, new_f, self._root_version, None, PList.GLOBAL_VERSION)
         self._root_version.child = new_v
 
         new_n.left_node = self._root_version.back.update_right(new_f, new_v)
 
         return PList(new_v)
 
+    @_write_locked
     def append_front(self, value):
 
-        PList.GLOBAL_VERSION += 1
-
         if self._root_version.front is None:
             return self._init_root(value)
 
-        new_n = ListNode(None, None, value, PList.GLOBAL_VERSION)
+        version = _next_version()
+
         new_f = ListFatNode()
+        new_v = VersionNode(new_f, self._root_version.back, self._root_version, None, version,
+                            self._root_version.size + 1)
+        new_n = ListNode(None, None, value, new_v)
         new_f.add(new_n)
-
-        new_v = VersionNode(new_f, self._root_version.back, self._root_version, None, PList.GLOBAL_VERSION)
         self._root_version.child = new_v
 
         new_n.right_node = self._root_version.front.update_left(new_f, new_v)
@@ -377,18 +734,268 @@ class PList(object):
 
     def _init_root(self, value):
 
-        new_n = ListNode(None, None, value, PList.GLOBAL_VERSION)
-
         new_f = ListFatNode()
-        new_f.add(new_n)
+        new_v = VersionNode(new_f, new_f, self._root_version, None, _next_version(), 1)
 
-        new_v = VersionNode(new_f, new_f, self._root_version, None, PList.GLOBAL_VERSION)
+        new_n = ListNode(None, None, value, new_v)
+        new_f.add(new_n)
 
         return PList(new_v)
 
 
-def plist():
-    return PList()
+class TreeNode(object):
+    """
+        Node of persistent weight-balanced tree, size - number of nodes in subtree
+    """
+    __slots__ = ('left', 'right', 'value', 'size')
+
+    # параметры баланса по весу (Adams)
+    DELTA = 3
+    RATIO = 2
+
+    def __new__(cls, left, value, right):
+        self = super(TreeNode, cls).__new__(cls)
+        self.left = left
+        self.right = right
+        self.value = value
+        self.size = _tree_size(left) + _tree_size(right) + 1
+        return self
+
+
+def _tree_size(node):
+    return node.size if node is not None else 0
+
+
+def _tree_balance(left, value, right):
+    """ Сборка ноды с восстановлением баланса после одной вставки/удаления """
+
+    size_l = _tree_size(left)
+    size_r = _tree_size(right)
+
+    if size_l + size_r <= 1:
+        return TreeNode(left, value, right)
+
+    if size_r > TreeNode.DELTA * size_l:
+        # перевес справа
+        rl, rr = right.left, right.right
+        if _tree_size(rl) < TreeNode.RATIO * _tree_size(rr):
+            return TreeNode(TreeNode(left, value, rl), right.value, rr)
+        return TreeNode(TreeNode(left, value, rl.left), rl.value, TreeNode(rl.right, right.value, rr))
+
+    if size_l > TreeNode.DELTA * size_r:
+        # перевес слева
+        ll, lr = left.left, left.right
+        if _tree_size(lr) < TreeNode.RATIO * _tree_size(ll):
+            return TreeNode(ll, left.value, TreeNode(lr, value, right))
+        return TreeNode(TreeNode(ll, left.value, lr.left), lr.value, TreeNode(lr.right, value, right))
+
+    return TreeNode(left, value, right)
+
+
+def _tree_get(node, index):
+    while True:
+        size_l = _tree_size(node.left)
+        if index < size_l:
+            node = node.left
+        elif index == size_l:
+            return node.value
+        else:
+            index -= size_l + 1
+            node = node.right
+
+
+def _tree_set(node, index, value):
+    size_l = _tree_size(node.left)
+    if index < size_l:
+        return TreeNode(_tree_set(node.left, index, value), node.value, node.right)
+    if index == size_l:
+        return TreeNode(node.left, value, node.right)
+    return TreeNode(node.left, node.value, _tree_set(node.right, index - size_l - 1, value))
+
+
+def _tree_insert(node, index, value):
+    if node is None:
+        return TreeNode(None, value, None)
+
+    size_l = _tree_size(node.left)
+    if index <= size_l:
+        return _tree_balance(_tree_insert(node.left, index, value), node.value, node.right)
+    return _tree_balance(node.left, node.value, _tree_insert(node.right, index - size_l - 1, value))
+
+
+def _tree_pop_first(node):
+    """ Возвращает (первое значение, дерево без него) """
+
+    if node.left is None:
+        return node.value, node.right
+    value, left = _tree_pop_first(node.left)
+    return value, _tree_balance(left, node.value, node.right)
+
+
+def _tree_remove(node, index):
+    size_l = _tree_size(node.left)
+    if index < size_l:
+        return _tree_balance(_tree_remove(node.left, index), node.value, node.right)
+    if index > size_l:
+        return _tree_balance(node.left, node.value, _tree_remove(node.right, index - size_l - 1))
+
+    # удаляем саму ноду, на ее место - минимальная нода правого поддерева
+    if node.left is None:
+        return node.right
+    if node.right is None:
+        return node.left
+    value, right = _tree_pop_first(node.right)
+    return _tree_balance(node.left, value, right)
+
+
+def _tree_build(values, lo, hi):
+    """ Perfectly balanced tree of values[lo:hi] """
+
+    if lo >= hi:
+        return None
+    mid = (lo + hi) // 2
+    return TreeNode(_tree_build(values, lo, mid), values[mid], _tree_build(values, mid + 1, hi))
+
+
+def _tree_iter(node):
+    stack = []
+    while stack or node is not None:
+        if node is not None:
+            stack.append(node)
+            node = node.left
+        else:
+            node = stack.pop()
+            yield node.value
+            node = node.right
+
+
+class TreeVersionNode(object):
+    """
+        Version of TreePList: root of the tree and links for undo/redo, like VersionNode
+    """
+    __slots__ = ('root', 'parent', 'child', '__weakref__')
+
+    def __new__(cls, root, parent):
+        self = super(TreeVersionNode, cls).__new__(cls)
+        self.root = root
+        self.parent = parent
+        self.child = None
+        return self
+
+
+class TreePList(object):
+    """
+        PList engine on persistent size-annotated balanced tree:
+        O(log n) indexed get/set/insert/remove, O(1) len.
+
+        Thread safety: tree nodes are never mutated, reads and writes need no locks
+    """
+
+    __slots__ = ('_root_version', '__weakref__', '_cached_hash')
+
+    def __init__(self, version_node=None):
+        if version_node:
+            self._root_version = version_node
+        else:
+            self._root_version = TreeVersionNode(None, None)
+
+    @classmethod
+    def from_iterable(cls, iterable):
+        """
+            Build plist in one pass: an empty root version and one version with all values
+        """
+        values = list(iterable)
+        l = cls()
+        return l._new_version(_tree_build(values, 0, len(values))) if values else l
+
+    def _new_version(self, root):
+        new_v = TreeVersionNode(root, self._root_version)
+        self._root_version.child = new_v
+        return TreePList(new_v)
+
+    def _check_index(self, index, upper):
+        if not isinstance(index, int):
+            raise TypeError("'%s' object cannot be interpreted as an index" % type(index).__name__)
+        assert 0 <= index < upper
+
+    def __str__(self):
+        return str(self.tolist())
+
+    def __iter__(self):
+        return _tree_iter(self._root_version.root)
+
+    def __hash__(self):
+        return _plist_hash(self)
+
+    def __eq__(self, other):
+        if not isinstance(other, (PList, TreePList)):
+            return NotImplemented
+        # общее дерево
+        if self is other or (type(other) is TreePList and self._root_version.root is other._root_version.root):
+            return True
+        return _plist_equal(self, other)
+
+    def __len__(self):
+        return _tree_size(self._root_version.root)
+
+    def undo(self):
+        if self._root_version.parent is None:
+            return None
+        return TreePList(self._root_version.parent)
+
+    def redo(self):
+        if self._root_version.child is None:
+            return None
+        return TreePList(self._root_version.child)
+
+    def front(self):
+        return self[0]
+
+    def back(self):
+        return self[len(self) - 1]
+
+    def tolist(self):
+        return list(self)
+
+    def __getitem__(self, item):
+        self._check_index(item, len(self))
+        return _tree_get(self._root_version.root, item)
+
+    def set(self, index, value):
+        self._check_index(index, len(self))
+        return self._new_version(_tree_set(self._root_version.root, index, value))
+
+    def insert(self, index, value):
+        self._check_index(index, len(self) + 1)
+        return self._new_version(_tree_insert(self._root_version.root, index, value))
+
+    def remove(self, index):
+        self._check_index(index, len(self))
+        return self._new_version(_tree_remove(self._root_version.root, index))
+
+    def append_back_list(self, list):
+        l = self
+        for x in list:
+            l = l.append_back(x)
+        return l
+
+    def append_back(self, value):
+        return self.insert(len(self), value)
+
+    def append_front(self, value):
+        return self.insert(0, value)
+
+
+FAT_NODE_ENGINE = 'fat_node'
+TREE_ENGINE = 'tree'
+
+
+def plist(iterable=(), engine=FAT_NODE_ENGINE):
+    if engine == FAT_NODE_ENGINE:
+        return PList.from_iterable(iterable)
+    if engine == TREE_ENGINE:
+        return TreePList.from_iterable(iterable)
+    raise ValueError("Unknown plist engine: %s" % (engine,))
 
 
 
@@ -1,57 +1,367 @@
 from itertools import chain
-from .pvector import pvector
+
+from .pvector import pvector, BIT_MASK, SHIFT, _bitcount
+
+# хеш ключа режется на куски по SHIFT бит, по одному на уровень дерева
+HASH_MASK = (1 << 64) - 1
+
+_MISSING = object()
+
+
+def _item_hash(key, val):
+    """ Shuffled hash of a pair, the map hash is xor of them (as in frozenset) """
+    h = hash((key, val)) & HASH_MASK
+    return (((h ^ 89869747) ^ (h << 16)) * 3644798167) & HASH_MASK
+
+
+def _finish_hash(items_hash, size):
+    h = items_hash ^ (((size + 1) * 1927868237) & HASH_MASK)
+    h ^= (h >> 11) ^ (h >> 25)
+    h = (h * 69069 + 907133923) & HASH_MASK
+    return h - (1 << 64) if h >> 63 else h
+
+
+class _BitmapIndexedNode(object):
+    """
+        HAMT node: bitmap of occupied slots and compact array of entries.
+        Entry is a (key, value) tuple or a child node
+    """
+
+    __slots__ = ('bitmap', 'array', 'owner')
+
+    def __init__(self, bitmap, array, owner=None):
+        self.bitmap = bitmap
+        self.array = array
+        # токен evolver'а, которому разрешено менять ноду на месте
+        self.owner = owner
+
+    def get(self, shift, h, key, default):
+        bit = 1 << ((h >> shift) & BIT_MASK)
+        if not self.bitmap & bit:
+            return default
+
+        entry = self.array[_bitcount(self.bitmap & (bit - 1))]
+        if type(entry) is tuple:
+            k, v = entry
+            if k is key or k == key:
+                return v
+            return default
+
+        return entry.get(shift + SHIFT, h, key, default)
+
+    def _replace(self, index, entry, owner):
+        """
+            Replace entry at index (in place if node is owned by evolver)
+        """
+        if owner is not None and self.owner is owner:
+            self.array[index] = entry
+            return self
+
+        array = list(self.array)
+        array[index] = entry
+        return _BitmapIndexedNode(self.bitmap, array, owner)
+
+    def assoc(self, shift, h, key, val, owner):
+        """
+            Set value by key, returns (node, True if key was added)
+        """
+        bit = 1 << ((h >> shift) & BIT_MASK)
+        index = _bitcount(self.bitmap & (bit - 1))
+
+        if self.bitmap & bit:
+            entry = self.array[index]
+            if type(entry) is tuple:
+                k, v = entry
+                if k is key or k == key:
+                    if v is val:
+                        return self, False
+                    return self._replace(index, (k, val), owner), False
+
+                # в слоте другой ключ - опускаем обе пары на уровень ниже
+                sub_node = _create_node(shift + SHIFT, k, v, h, key, val, owner)
+                return self._replace(index, sub_node, owner), True
+
+            sub_node, added = entry.assoc(shift + SHIFT, h, key, val, owner)
+            if sub_node is entry:
+                return self, added
+            return self._replace(index, sub_node, owner), added
+
+        # слот свободен
+        if owner is not None and self.owner is owner:
+            self.array.insert(index, (key, val))
+            self.bitmap |= bit
+            return self, True
+
+        array = self.array[:index]
+        array.append((key, val))
+        array.extend(self.array[index:])
+        return _BitmapIndexedNode(self.bitmap | bit, array, owner), True
+
+    def without(self, shift, h, key, owner):
+        """
+            Remove key, returns (node or None if node is empty, True if key was removed)
+        """
+        bit = 1 << ((h >> shift) & BIT_MASK)
+        if not self.bitmap & bit:
+            return self, False
+
+        index = _bitcount(self.bitmap & (bit - 1))
+        entry = self.array[index]
+        if type(entry) is tuple:
+            k, _ = entry
+            if not (k is key or k == key):
+                return self, False
+        else:
+            sub_node, removed = entry.without(shift + SHIFT, h, key, owner)
+            if not removed:
+                return self, False
+            if sub_node is not None:
+                # сжимаем и при изменении на месте: sub_node мог остаться с одной записью
+                sub_node = _compact(sub_node)
+                if sub_node is entry:
+                    return self, True
+                return self._replace(index, sub_node, owner), True
+
+        # удаляем слот
+        if self.bitmap == bit:
+            return None, True
+
+        if owner is not None and self.owner is owner:
+            del self.array[index]
+            self.bitmap ^= bit
+            return self, True
+
+        array = self.array[:index]
+        array.extend(self.array[index + 1:])
+        return _BitmapIndexedNode(self.bitmap ^ bit, array, owner), True
+
+    def iteritems(self):
+        for entry in self.array:
+            if type(entry) is tuple:
+                yield entry
+            else:
+                yield from entry.iteritems()
+
+
+class _CollisionNode(object):
+    """
+        HAMT node for keys with equal hashes: plain array of (key, value) pairs
+    """
+
+    __slots__ = ('hash', 'array', 'owner')
+
+    def __init__(self, h, array, owner=None):
+        self.hash = h
+        self.array = array
+        self.owner = owner
+
+    def _find(self, key):
+        for i, (k, _) in enumerate(self.array):
+            if k is key or k == key:
+                return i
+        return -1
+
+    def get(self, shift, h, key, default):
+        if h != self.hash:
+            return default
+
+        index = self._find(key)
+        if index < 0:
+            return default
+        return self.array[index][1]
+
+    def assoc(self, shift, h, key, val, owner):
+        if h != self.hash:
+            # другой хеш с тем же префиксом - подвешиваем коллизию в bitmap ноду
+            node = _BitmapIndexedNode(1 << ((self.hash >> shift) & BIT_MASK), [self], owner)
+            return node.assoc(shift, h, key, val, owner)
+
+        index = self._find(key)
+        in_place = owner is not None and self.owner is owner
+
+        if index < 0:
+            if in_place:
+                self.array.append((key, val))
+                return self, True
+            return _CollisionNode(h, self.array + [(key, val)], owner), True
+
+        k, v = self.array[index]
+        if v is val:
+            return self, False
+        if in_place:
+            self.array[index] = (k, val)
+            return self, False
+
+        array = list(self.array)
+        array[index] = (k, val)
+        return _CollisionNode(h, array, owner), False
+
+    def without(self, shift, h, key, owner):
+        if h != self.hash:
+            return self, False
+
+        index = self._find(key)
+        if index < 0:
+            return self, False
+
+        if len(self.array) == 1:
+            return None, True
+
+        if owner is not None and self.owner is owner:
+            del self.array[index]
+            return self, True
+
+        array = self.array[:index]
+        array.extend(self.array[index + 1:])
+        return _CollisionNode(h, array, owner), True
+
+    def iteritems(self):
+        return iter(self.array)
+
+
+def _create_node(shift, key1, val1, h2, key2, val2, owner):
+    """
+        Create node holding two pairs whose hashes are equal up to shift
+    """
+    h1 = hash(key1) & HASH_MASK
+    if h1 == h2:
+        return _CollisionNode(h1, [(key1, val1), (key2, val2)], owner)
+
+    node = _BitmapIndexedNode(1 << ((h1 >> shift) & BIT_MASK), [(key1, val1)], owner)
+    node, _ = node.assoc(shift, h2, key2, val2, owner)
+    return node
+
+
+def _compact(node):
+    """
+        Pull the only pair or collision node of node up into the parent slot, so removes
+        do not leave chains of one-entry nodes and the trie matches a freshly built one
+    """
+    if len(node.array) != 1:
+        return node
+    if type(node) is _CollisionNode:
+        return node.array[0]
+    entry = node.array[0]
+    # коллизия хранит полный хеш и может висеть на любом уровне
+    if type(entry) is tuple or type(entry) is _CollisionNode:
+        return entry
+    return node
+
+
+def _entry_items(entry):
+    return [entry] if type(entry) is tuple else list(entry.iteritems())
+
+
+def _entry_get(entry, shift, key):
+    """
+        Lookup key in a trie slot entry (pair or node) of level shift
+    """
+    if type(entry) is tuple:
+        k, v = entry
+        return v if k is key or k == key else _MISSING
+    return entry.get(shift, hash(key) & HASH_MASK, key, _MISSING)
+
+
+def _nodes_equal(a, b, shift=0):
+    """
+        Compare trie entries covering the same hash prefix at level shift.
+        Shared subtrees are skipped and nodes of the same shape are compared slot by slot,
+        otherwise the contents are compared by lookup
+    """
+    if a is b:
+        return True
+
+    if type(a) is _BitmapIndexedNode and type(b) is _BitmapIndexedNode and a.bitmap == b.bitmap:
+        shift += SHIFT
+        for x, y in zip(a.array, b.array):
+            if not _nodes_equal(x, y, shift):
+                return False
+        return True
+
+    if type(a) is tuple and type(b) is tuple:
+        return (a[0] is b[0] or a[0] == b[0]) and (a[1] is b[1] or a[1] == b[1])
+
+    # разная форма - сравниваем содержимое поиском
+    items = _entry_items(a)
+    if len(items) != len(_entry_items(b)):
+        return False
+    for k, v in items:
+        other = _entry_get(b, shift, k)
+        if other is _MISSING or not (other is v or other == v):
+            return False
+    return True
+
+
+_EMPTY_NODE = _BitmapIndexedNode(0, [])
+
+
+class _MapVersion(object):
+    """
+        Node of pmap history for undo/redo
+    """
+
+    __slots__ = ('root', 'size', 'parent', 'child')
+
+    def __init__(self, root, size, parent=None):
+        self.root = root
+        self.size = size
+        self.parent = parent
+        self.child = None
 
 
 class PMap(object):
+    """
+        Persistent map on hash array mapped trie.
+
+        set/remove copy only the path from the root to the key (at most 64 / SHIFT nodes),
+        the trie never rehashes, so there are no O(n) pauses on growth.
 
-    __slots__ = ('_size', '_buckets', '__weakref__', '_cached_hash')
+        Thread safety: trie nodes of a map are never mutated, so lookups, set, remove and
+        undo/redo may run from any thread without locks. An evolver belongs to a single thread
+    """
 
-    def __new__(cls, size, buckets):
+    __slots__ = ('_size', '_root', '_version', '__weakref__', '_items_hash')
+
+    def __new__(cls, size, root, version=None):
         self = super(PMap, cls).__new__(cls)
         self._size = size
-        # pvector с (key, value) парами
-        self._buckets = buckets
+        # xor хешей пар, None пока хеш не нужен; evolver поддерживает его при изменениях
+        self._items_hash = None
+        # корень HAMT с (key, value) парами
+        self._root = root
+        self._version = version if version is not None else _MapVersion(root, size)
         return self
 
-    @staticmethod
-    def _get_bucket(buckets, key):
+    def _derive(self, size, root):
         """
-            Get bucket by key
+            Create next version of pmap
         """
-        index = hash(key) % len(buckets)
-        bucket = buckets[index]
-        return index, bucket
+        version = _MapVersion(root, size, self._version)
+        self._version.child = version
+        return PMap(size, root, version)
 
     @staticmethod
-    def _getitem(buckets, key):
+    def _getitem(root, key):
         """
             Get item by key
         """
-        _, bucket = PMap._get_bucket(buckets, key)
-        if bucket:
-            for k, v in bucket:
-                if k == key:
-                    return v
-        raise KeyError(key)
+        val = root.get(0, hash(key) & HASH_MASK, key, _MISSING)
+        if val is _MISSING:
+            raise KeyError(key)
+        return val
 
     @staticmethod
-    def _contains(buckets, key):
+    def _contains(root, key):
         """
             Check for item with key
         """
-        _, bucket = PMap._get_bucket(buckets, key)
-        if bucket:
-            for k, _ in bucket:
-                if k == key:
-                    return True
-            return False
-        return False
+        return root.get(0, hash(key) & HASH_MASK, key, _MISSING) is not _MISSING
 
     def __getitem__(self, key):
-        return PMap._getitem(self._buckets, key)
+        return PMap._getitem(self._root, key)
 
     def __contains__(self, key):
-        return self._contains(self._buckets, key)
+        return self._contains(self._root, key)
 
     def __iter__(self):
         return self.iterkeys()
@@ -64,21 +374,25 @@ class PMap(object):
                 "{0} has no attribute '{1}'".format(type(self).__name__, key)
             ) from e
 
-    def _undo(self):
-        self._buckets = self._buckets.undo()
-        self._size = len(list(self.iterkeys()))
+    @staticmethod
+    def _from_version(version):
+        return PMap(version.size, version.root, version)
 
     def undo(self):
-        self._undo()
-        return self
-
-    def _redo(self):
-        self._buckets = self._buckets.redo()
-        self._size = len(list(self.iterkeys()))
+        """
+            Previous version of pmap in O(1), self for the first version
+        """
+        if self._version.parent is None:
+            return self
+        return self._from_version(self._version.parent)
 
     def redo(self):
-        self._redo()
-        return self
+        """
+            Next version of pmap in O(1), self for the last version
+        """
+        if self._version.child is None:
+            return self
+        return self._from_version(self._version.child)
 
     def iterkeys(self):
         """
@@ -98,10 +412,7 @@ class PMap(object):
         """
             Iter pmap items: (key, value)
         """
-        for bucket in self._buckets:
-            if bucket:
-                for k, v in bucket:
-                    yield k, v
+        return self._root.iteritems()
 
     def values(self):
         return pvector(self.itervalues())
@@ -122,9 +433,24 @@ class PMap(object):
         return self.__repr__()
 
     def __hash__(self):
-        if not hasattr(self, '_cached_hash'):
-            self._cached_hash = hash(frozenset(self.iteritems()))
-        return self._cached_hash
+        if self._items_hash is None:
+            items_hash = 0
+            for k, v in self.iteritems():
+                items_hash ^= _item_hash(k, v)
+            self._items_hash = items_hash
+        return _finish_hash(self._items_hash, self._size)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, PMap):
+            return NotImplemented
+        if self._size != other._size:
+            return False
+        if self._items_hash is not None and other._items_hash is not None \
+                and self._items_hash != other._items_hash:
+            return False
+        return _nodes_equal(self._root, other._root)
 
     def set(self, key, val):
         """
@@ -153,76 +479,61 @@ class PMap(object):
         return evolver.persistent()
 
     class _Evolver(object):
-        __slots__ = ('_buckets_evolver', '_size', '_original_pmap')
+        __slots__ = ('_root', '_size', '_owner', '_original_pmap', '_items_hash')
 
         def __init__(self, original_pmap):
             self._original_pmap = original_pmap
-            self._buckets_evolver = original_pmap._buckets.evolver()
+            self._root = original_pmap._root
             self._size = original_pmap._size
+            # хеш поддерживается, только если он уже был посчитан у исходной pmap
+            self._items_hash = original_pmap._items_hash
+            # ноды, созданные с этим токеном, evolver меняет на месте
+            self._owner = object()
 
         def __getitem__(self, key):
-            return PMap._getitem(self._buckets_evolver, key)
+            return PMap._getitem(self._root, key)
 
         def __setitem__(self, key, val):
             self.set(key, val)
 
         def set(self, key, val):
-            # buckets overflow
-            if len(self._buckets_evolver) < 0.67 * self._size:
-                self._reallocate(2 * len(self._buckets_evolver))
-
-            kv = (key, val)
-            # находим бакет элемента
-            index, bucket = PMap._get_bucket(self._buckets_evolver, key)
-            if bucket:
-                for k, v in bucket:
-                    if k == key:
-                        # находим элемент в бакете
-                        if v is not val:
-                            # создаем новый бакет (копируем и выставляем новое значение по ключу)
-                            # заменяем бакет в pvector evolver
-                            new_bucket = [(k2, v2) if k2 != k else (k2, val) for k2, v2 in bucket]
-                            self._buckets_evolver[index] = new_bucket
-
-                        return self
-                # ключа нет в бакете - создаем новый бакет с доп парой (key, value)
-                new_bucket = [kv]
-                new_bucket.extend(bucket)
-                self._buckets_evolver[index] = new_bucket
-                self._size += 1
-            else:
-                # бакет не найден, создаем новый
-                self._buckets_evolver[index] = [kv]
+            h = hash(key) & HASH_MASK
+            old = self._root.get(0, h, key, _MISSING) if self._items_hash is not None else _MISSING
+
+            # копируем только путь от корня до листа, остальные ноды разделяются
+            self._root, added = self._root.assoc(0, h, key, val, self._owner)
+            if added:
                 self._size += 1
 
+            if self._items_hash is not None:
+                self._update_hash(key, old, val)
             return self
 
-        def _reallocate(self, new_size):
-            # увеличиваем кол-во бакетов в два раза
-            new_list = new_size * [None]
-            buckets = self._buckets_evolver.persistent()
-            for k, v in chain.from_iterable(x for x in buckets if x):
-                index = hash(k) % new_size
-                if new_list[index]:
-                    new_list[index].append((k, v))
-                else:
-                    new_list[index] = [(k, v)]
-            # создаем новый pvector для бакетов
-            self._buckets_evolver = pvector().evolver()
-            self._buckets_evolver.extend(new_list)
+        def _update_hash(self, key, old, new):
+            try:
+                if old is not _MISSING:
+                    self._items_hash ^= _item_hash(key, old)
+                if new is not _MISSING:
+                    self._items_hash ^= _item_hash(key, new)
+            except TypeError:
+                # нехешируемое значение - хеш больше не поддерживаем
+                self._items_hash = None
 
         def is_dirty(self):
             """
                 Check evolver for modifications
             """
-            return self._buckets_evolver.is_dirty()
+            return self._root is not self._original_pmap._root
 
         def persistent(self):
             """
                 Create persistent pmap form evolver view
             """
             if self.is_dirty():
-                self._original_pmap = PMap(self._size, self._buckets_evolver.persistent())
+                # новый токен: ноды, отданные в pmap, больше не меняются на месте
+                self._owner = object()
+                self._original_pmap = self._original_pmap._derive(self._size, self._root)
+                self._original_pmap._items_hash = self._items_hash
 
             return self._original_pmap
 
@@ -230,49 +541,51 @@ class PMap(object):
             return self._size
 
         def __contains__(self, key):
-            return PMap._contains(self._buckets_evolver, key)
+            return PMap._contains(self._root, key)
 
         def remove(self, key):
-            # находим бакет с элементом
-            index, bucket = PMap._get_bucket(self._buckets_evolver, key)
+            h = hash(key) & HASH_MASK
+            old = self._root.get(0, h, key, _MISSING) if self._items_hash is not None else _MISSING
 
-            if bucket:
-                # создаем новый бакет без значения с ключом key
-                new_bucket = [(k, v) for (k, v) in bucket if k != key]
-                if len(bucket) > len(new_bucket):
-                    # ключ был в бакете
-                    self._buckets_evolver[index] = new_bucket if new_bucket else None
-                    self._size -= 1
-                    return self
+            root, removed = self._root.without(0, h, key, self._owner)
+            if not removed:
+                raise KeyError('{0}'.format(key))
 
-            raise KeyError('{0}'.format(key))
+            self._root = root if root is not None else _EMPTY_NODE
+            self._size -= 1
+            if self._items_hash is not None:
+                self._update_hash(key, old, _MISSING)
+            return self
 
     def evolver(self):
         return self._Evolver(self)
 
+    @classmethod
+    def from_items(cls, items):
+        """
+            Build pmap from (key, value) pairs in one transient pass: trie nodes are
+            created by one evolver and filled in place
+        """
+        # пустая версия - начало истории, как у pvector
+        evolver = cls(0, _EMPTY_NODE).evolver()
 
-def mapping(initial):
-    size = 8
-
-    # создаем бакеты для хранения массивов пар (key, value)
-    buckets = size * [None]
+        for k, v in items:
+            evolver.set(k, v)
 
-    # для каждого ключа вычисляем номер бакета и добавляем по индексу
-    for k, v in initial.items():
-        h = hash(k)
-        index = h % size
-        bucket = buckets[index]
+        return evolver.persistent()
 
-        if bucket:
-            bucket.append((k, v))
-        else:
-            buckets[index] = [(k, v)]
 
-    # создаем pvector, который хранит бакеты
-    return PMap(len(initial), pvector().extend(buckets))
+def mapping(initial):
+    return PMap.from_items(initial.items())
 
 _EMPTY_PMAP = mapping({})
 
 
-def pmap(**kwargs):
-    return mapping(kwargs)
+def pmap(initial=(), /, **kwargs):
+    """
+        Create pmap from a mapping or an iterable of (key, value) pairs and keyword arguments
+    """
+    items = initial.items() if hasattr(initial, 'items') else initial
+    if kwargs:
+        items = chain(items, kwargs.items())
+    return PMap.from_items(items)
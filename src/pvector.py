@@ -1,5 +1,10 @@
+from array import array
+from collections import deque
+from itertools import chain, count, islice
 from numbers import Integral
 import operator
+import threading
+import weakref
 
 def _bitcount(val):
     return bin(val).count("1")
@@ -9,9 +14,468 @@ BRANCH_FACTOR = 32 #
 BIT_MASK = BRANCH_FACTOR - 1
 SHIFT = _bitcount(BIT_MASK)
 
+# пустой фокус: диапазон [0, 0) не содержит индексов
+_NO_FOCUS = (0, 0, None)
+
+# константы xxHash, как в хеше tuple CPython (64 бит)
+_HASH_MASK = (1 << 64) - 1
+_XXPRIME_1 = 11400714785074694791
+_XXPRIME_2 = 14029467366897019727
+_XXPRIME_5 = 2870177450012600261
+
+_EQUALITY_OPERATORS = (operator.eq, operator.ne)
+
 
 def compare_pvector(v, other, operator):
-    return operator(v.tolist(), other.tolist() if isinstance(other, PythonPVector) else other)
+    """ Лексикографическое сравнение потоком, без копирования в list """
+
+    if not isinstance(other, (PythonPVector, list)):
+        return operator(v.tolist(), other)
+
+    # как у list: равенство векторов разной длины решается без обхода
+    if len(v) != len(other) and operator in _EQUALITY_OPERATORS:
+        return operator(len(v), len(other))
+
+    for x, y in zip(v, other):
+        if not (x is y or x == y):
+            return operator(x, y)
+
+    return operator(len(v), len(other))
+
+
+def _hash_sequence(iterable, length):
+    """ Хеш последовательности как у tuple (xxHash), потоком без копирования элементов """
+
+    acc = _XXPRIME_5
+    for x in iterable:
+        acc = (acc + (hash(x) & _HASH_MASK) * _XXPRIME_2) & _HASH_MASK
+        acc = ((acc << 31) | (acc >> 33)) & _HASH_MASK
+        acc = (acc * _XXPRIME_1) & _HASH_MASK
+
+    acc = (acc + (length ^ (_XXPRIME_5 ^ 3527539))) & _HASH_MASK
+    if acc == _HASH_MASK:
+        return 1546275796
+    return acc - (1 << 64) if acc >> 63 else acc
+
+
+def _leaves_equal(left, right):
+    """
+        Сравнение двух потоков листьев с одинаковым кол-вом элементов:
+        один и тот же лист на одной позиции пропускается без сравнения элементов
+    """
+    a = b = ()
+    i = j = 0
+    while True:
+        if i == len(a):
+            a = next(left, None)
+            if a is None:
+                return True
+            i = 0
+            continue
+        if j == len(b):
+            b = next(right, ())
+            j = 0
+            continue
+
+        if i == 0 and j == 0 and a is b:
+            i = j = len(a)
+            continue
+
+        n = min(len(a) - i, len(b) - j)
+        if type(a) is type(b):
+            if a[i:i + n] != b[j:j + n]:
+                return False
+        # array и list не сравниваются между собой - поэлементно
+        elif any(x != y for x, y in zip(islice(a, i, i + n), islice(b, j, j + n))):
+            return False
+        i += n
+        j += n
+
+
+def _pvector_equal(v, other):
+    if v is other:
+        return True
+    if v._count != other._count:
+        return False
+    # общая структура - векторы равны без обхода
+    if v._root is other._root and v._tail is other._tail:
+        return True
+    if v._cached_hash is not None and other._cached_hash is not None and v._cached_hash != other._cached_hash:
+        return False
+    return _leaves_equal(v._iter_leaves(), other._iter_leaves())
+
+
+def _leaves(node, shift):
+    """ Итератор по листьям поддерева node уровня shift слева направо """
+
+    if shift == 0:
+        return iter((node,))
+    if shift == SHIFT:
+        return iter(node)
+    shift -= SHIFT
+    return chain.from_iterable(_leaves(n, shift) for n in node)
+
+
+def _reversed_leaves(node, shift):
+    """ Итератор по листьям поддерева node уровня shift справа налево """
+
+    if shift == 0:
+        return iter((node,))
+    if shift == SHIFT:
+        return reversed(node)
+    shift -= SHIFT
+    return chain.from_iterable(_reversed_leaves(n, shift) for n in reversed(node))
+
+
+class _RelaxedNode(list):
+    """
+        Внутренняя нода relaxed radix дерева (RRB): потомки могут быть неполными,
+        sizes - накопленные размеры поддеревьев потомков.
+
+        Обычная list нода - плотное поддерево: все листья полные, все потомки кроме
+        последнего полные, поиск по битам индекса
+    """
+    __slots__ = ('sizes',)
+
+
+def _relaxed(children, sizes):
+    node = _RelaxedNode(children)
+    node.sizes = sizes
+    return node
+
+
+def _tree_size(node, shift):
+    """ Кол-во элементов в поддереве node уровня shift """
+
+    if shift == 0:
+        return len(node)
+    if type(node) is _RelaxedNode:
+        return node.sizes[-1]
+    if not node:
+        return 0
+    # плотное поддерево: все потомки кроме последнего полные
+    return ((len(node) - 1) << shift) + _tree_size(node[-1], shift - SHIFT)
+
+
+def _relaxed_index(node, i, shift):
+    """ Индекс потомка relaxed ноды с элементом i и кол-во элементов до этого потомка """
+
+    sizes = node.sizes
+    # в потомке не больше 1 << shift элементов, поэтому начинаем с i >> shift
+    index = i >> shift
+    while sizes[index] <= i:
+        index += 1
+    return index, sizes[index - 1] if index else 0
+
+
+def _child_index(node, i, shift):
+    if type(node) is _RelaxedNode:
+        return _relaxed_index(node, i, shift)
+    index = (i >> shift) & BIT_MASK
+    return index, index << shift
+
+
+def _new_path(level, node):
+    # 1) _shift, _tail
+    if level == 0:
+        return node
+
+    return [_new_path(level - SHIFT, node)]
+
+
+def _make_node(children, shift):
+    """
+        Нода уровня shift из потомков: плотная list, если потомки плотные и
+        все кроме последнего полные, иначе relaxed с таблицей размеров
+    """
+    child_shift = shift - SHIFT
+    full_size = 1 << shift
+    last = len(children) - 1
+    sizes = []
+    total = 0
+    dense = True
+
+    for k, child in enumerate(children):
+        size = _tree_size(child, child_shift)
+        total += size
+        sizes.append(total)
+        if dense:
+            if child_shift == 0:
+                dense = size == full_size
+            else:
+                dense = type(child) is list and (k == last or size == full_size)
+
+    if dense:
+        return list(children)
+    return _relaxed(children, sizes)
+
+
+def _take(node, shift, n):
+    """ Первые n элементов поддерева (n на границе листа), листья и поддеревья разделяются """
+
+    if shift == 0 or n == _tree_size(node, shift):
+        return node
+
+    index, offset = _child_index(node, n - 1, shift)
+    children = node[:index]
+    children.append(_take(node[index], shift - SHIFT, n - offset))
+    return _make_node(children, shift)
+
+
+def _drop(node, shift, n):
+    """ Поддерево без первых n элементов (0 < n < размера поддерева) """
+
+    if shift == 0:
+        return node[n:]
+
+    index, offset = _child_index(node, n, shift)
+    child = node[index]
+    children = [_drop(child, shift - SHIFT, n - offset) if n > offset else child]
+    children.extend(node[index + 1:])
+    return _make_node(children, shift)
+
+
+def _dense_push(node, shift, size, leaf):
+    """ Полный лист справа в плотное поддерево размера size (как _push_tail) """
+
+    ret = list(node)
+    if shift == SHIFT:
+        ret.append(leaf)
+        return ret
+
+    sub_index = (size >> shift) & BIT_MASK
+    if sub_index < len(node):
+        ret[sub_index] = _dense_push(node[sub_index], shift - SHIFT, size - (sub_index << shift), leaf)
+    else:
+        ret.append(_new_path(shift - SHIFT, leaf))
+    return ret
+
+
+def _push_leaf(node, shift, leaf):
+    """ Лист справа в поддерево node уровня shift, None если в поддереве нет места """
+
+    if type(node) is not _RelaxedNode:
+        size = _tree_size(node, shift)
+        if size == 1 << (shift + SHIFT):
+            return None
+        return _dense_push(node, shift, size, leaf)
+
+    sizes = node.sizes
+    if shift > SHIFT:
+        child = _push_leaf(node[-1], shift - SHIFT, leaf)
+        if child is not None:
+            children = list(node)
+            children[-1] = child
+            return _relaxed(children, sizes[:-1] + [sizes[-1] + len(leaf)])
+
+    if len(node) == BRANCH_FACTOR:
+        return None
+
+    children = list(node)
+    children.append(_new_path(shift - SHIFT, leaf))
+    return _relaxed(children, sizes + [sizes[-1] + len(leaf)])
+
+
+# допустимое кол-во лишних нод при конкатенации сверх оптимального (RRB, e = 2)
+_CONCAT_EXTRAS = 2
+# нода с числом слотов больше BRANCH_FACTOR - _CONCAT_INVARIANT не перераспределяется
+_CONCAT_INVARIANT = 1
+
+
+def _concat_plan(nodes):
+    """ Размеры нод после перераспределения слотов (план конкатенации RRB) """
+
+    plan = [len(n) for n in nodes]
+    optimal = (sum(plan) - 1) // BRANCH_FACTOR + 1
+    length = len(plan)
+    i = 0
+
+    while length > optimal + _CONCAT_EXTRAS:
+        # пропускаем достаточно заполненные ноды
+        while plan[i] > BRANCH_FACTOR - _CONCAT_INVARIANT:
+            i += 1
+
+        # раскладываем слоты короткой ноды по следующим нодам
+        remaining = plan[i]
+        while remaining > 0:
+            size = min(remaining + plan[i + 1], BRANCH_FACTOR)
+            plan[i] = size
+            remaining += plan[i + 1] - size
+            i += 1
+
+        del plan[i]
+        length -= 1
+        i -= 1
+
+    return plan
+
+
+def _execute_plan(nodes, plan, shift):
+    """ Перекладывает слоты нод уровня shift по плану, ноды с неизменным размером разделяются """
+
+    result = []
+    k = 0
+    offset = 0
+
+    for size in plan:
+        node = nodes[k]
+        if offset == 0 and len(node) == size:
+            result.append(node)
+            k += 1
+            continue
+
+        # пустая нода того же типа (list или лист)
+        slots = node[:0] if shift == 0 else []
+        while len(slots) < size:
+            node = nodes[k]
+            taken = min(size - len(slots), len(node) - offset)
+            slots.extend(node[offset:offset + taken])
+            offset += taken
+            if offset == len(node):
+                k += 1
+                offset = 0
+
+        result.append(slots if shift == 0 else _make_node(slots, shift))
+
+    return result
+
+
+def _rebalance(left, middle, right, shift):
+    """
+        Склейка потомков left (кроме последнего), middle и right (кроме первого) уровня shift,
+        результат - нода уровня shift + SHIFT с одним или двумя потомками
+    """
+    nodes = list(left[:-1]) if left is not None else []
+    nodes.extend(middle)
+    if right is not None:
+        nodes.extend(right[1:])
+
+    child_shift = shift - SHIFT
+    nodes = _execute_plan(nodes, _concat_plan(nodes), child_shift)
+
+    if len(nodes) <= BRANCH_FACTOR:
+        return [_make_node(nodes, shift)]
+    return [_make_node(nodes[:BRANCH_FACTOR], shift), _make_node(nodes[BRANCH_FACTOR:], shift)]
+
+
+def _concat_sub(left, left_shift, right, right_shift):
+    """ Конкатенация поддеревьев, результат - потомки ноды уровня max(shift) + SHIFT """
+
+    if left_shift > right_shift:
+        middle = _concat_sub(left[-1], left_shift - SHIFT, right, right_shift)
+        return _rebalance(left, middle, None, left_shift)
+
+    if left_shift < right_shift:
+        middle = _concat_sub(left, left_shift, right[0], right_shift - SHIFT)
+        return _rebalance(None, middle, right, right_shift)
+
+    if left_shift == 0:
+        return [left, right]
+
+    middle = _concat_sub(left[-1], left_shift - SHIFT, right[0], right_shift - SHIFT)
+    return _rebalance(left, middle, right, left_shift)
+
+
+def _concat_trees(left, left_shift, right, right_shift):
+    """ Конкатенация непустых деревьев за O(log n), возвращает (root, shift) """
+
+    shift = max(left_shift, right_shift)
+    children = _concat_sub(left, left_shift, right, right_shift)
+    if len(children) > 1:
+        return _make_node(children, shift + SHIFT), shift + SHIFT
+
+    # убираем лишние уровни
+    root = children[0]
+    while shift > SHIFT and len(root) == 1:
+        root = root[0]
+        shift -= SHIFT
+    return root, shift
+
+
+class _TrieBuilder(object):
+    """
+        Сборка плотного дерева снизу вверх за O(n): на каждом уровне одна открытая нода,
+        заполненная нода закрывается и уходит потомком в открытую ноду уровнем выше.
+        Можно продолжить плотное дерево: открытые ноды - копии его правого края
+    """
+    __slots__ = ('_levels',)
+
+    def __init__(self, root=None, shift=SHIFT, tree_size=0):
+        # _levels[k] - потомки открытой ноды уровня (k + 1) * SHIFT
+        self._levels = []
+        if not tree_size:
+            return
+
+        spine = []
+        node = root
+        while shift:
+            spine.append(node)
+            node = node[-1]
+            shift -= SHIFT
+
+        # нижняя нода правого края открыта целиком, у верхних последний потомок - открытая нода ниже
+        self._levels.append(list(spine[-1]))
+        for node in reversed(spine[:-1]):
+            self._levels.append(node[:-1])
+
+    def add_leaf(self, leaf):
+        self._add(0, leaf)
+
+    def _add(self, k, node):
+        if k == len(self._levels):
+            self._levels.append([])
+
+        level = self._levels[k]
+        if len(level) == BRANCH_FACTOR:
+            self._add(k + 1, level)
+            level = self._levels[k] = []
+        level.append(node)
+
+    def root(self):
+        """ Закрываем открытые ноды снизу вверх (builder больше не используется), возвращает (root, shift) """
+
+        if not self._levels or not self._levels[0]:
+            return [], SHIFT
+
+        # закрытие ноды может переполнить уровень выше и добавить новый уровень
+        k = 0
+        while k + 1 < len(self._levels):
+            node = self._levels[k]
+            self._levels[k] = []
+            self._add(k + 1, node)
+            k += 1
+
+        node = self._levels[-1]
+        shift = len(self._levels) * SHIFT
+
+        # убираем лишние уровни
+        while shift > SHIFT and len(node) == 1:
+            node = node[0]
+            shift -= SHIFT
+        return node, shift
+
+
+def _as_leaf(empty, chunk):
+    """ chunk как лист того же типа, что empty (list или array с тем же typecode) """
+
+    if type(chunk) is type(empty) and (type(empty) is list or chunk.typecode == empty.typecode):
+        return chunk
+    leaf = empty[:]
+    leaf.extend(chunk)
+    return leaf
+
+
+def _numpy_typecode(dtype):
+    """ Код типа array.array с тем же представлением, что у dtype numpy, или None """
+
+    if not dtype.isnative or dtype.kind not in 'iuf':
+        return None
+
+    codes = {'i': 'bhilq', 'u': 'BHILQ', 'f': 'fd'}[dtype.kind]
+    for typecode in codes:
+        if array(typecode).itemsize == dtype.itemsize:
+            return typecode
+    return None
 
 
 def _index_or_slice(index, stop):
@@ -20,20 +484,190 @@ def _index_or_slice(index, stop):
     return slice(index, stop)
 
 
+class VersionHistory(object):
+    """
+        История версий семейства векторов.
+
+        Каждой сохраненной версии выдается version_id (по порядку создания),
+        undo/redo/checkout - поиск по id в словаре за O(1).
+
+        Политики хранения:
+            UNBOUNDED - все версии (сильные ссылки)
+            LAST      - последние max_versions версий
+            WEAK      - слабые ссылки, версия живет пока на нее есть ссылки снаружи
+            OFF       - история не ведется, undo/redo возвращают сам вектор
+
+        previous/next за O(1) при любой политике: у UNBOUNDED и LAST сохраненные id идут подряд,
+        у WEAK живые id связаны в двусвязный список, из которого умершие версии выпадают за O(1)
+    """
+
+    UNBOUNDED = 'unbounded'
+    LAST = 'last'
+    WEAK = 'weak'
+    OFF = 'off'
+
+    __slots__ = ('_policy', '_max_versions', '_versions', '_ids', '_last_id',
+                 '_links', '_last_live', '_dead', '_lock')
+
+    def __init__(self, policy=UNBOUNDED, max_versions=None):
+        if policy not in (self.UNBOUNDED, self.LAST, self.WEAK, self.OFF):
+            raise ValueError("Unknown history policy: %s" % (policy,))
+
+        if policy == self.LAST and (max_versions is None or max_versions < 1):
+            raise ValueError("LAST policy needs max_versions >= 1")
+
+        self._policy = policy
+        self._max_versions = max_versions if policy == self.LAST else None
+        # version_id -> вектор
+        self._versions = weakref.WeakValueDictionary() if policy == self.WEAK else {}
+        self._ids = count()
+        self._last_id = -1
+
+        if policy == self.WEAK:
+            # version_id -> [prev_id, next_id, ref] для живых версий
+            self._links = {}
+            self._last_live = None
+            # ref'ы умерших версий: callback только кладет их в очередь (он может сработать
+            # посреди add при сборке мусора), из списка они удаляются под блокировкой
+            self._dead = deque()
+            self._lock = threading.Lock()
+
+    @property
+    def policy(self):
+        return self._policy
+
+    @property
+    def max_versions(self):
+        return self._max_versions
+
+    def add(self, version):
+        """ Регистрация новой версии, возвращает ее version_id """
+
+        version_id = next(self._ids)
+        self._last_id = version_id
+
+        if self._policy == self.OFF:
+            return version_id
+
+        self._versions[version_id] = version
+        if self._policy == self.WEAK:
+            ref = weakref.KeyedRef(version, self._dead.append, version_id)
+            with self._lock:
+                self._unlink_dead()
+                if self._last_live is not None:
+                    self._links[self._last_live][1] = version_id
+                self._links[version_id] = [self._last_live, None, ref]
+                self._last_live = version_id
+        elif self._max_versions is not None:
+            # вытесняем версию, вышедшую из окна
+            self._versions.pop(version_id - self._max_versions, None)
+
+        return version_id
+
+    def _first_id(self):
+        if self._max_versions is not None:
+            return max(0, self._last_id - self._max_versions + 1)
+        return 0
+
+    def get(self, version_id):
+        """ Версия по id или None, если она не сохранена """
+
+        return self._versions.get(version_id)
+
+    def _unlink_dead(self):
+        """ Удаление умерших версий из списка живых, вызывается под self._lock """
+
+        while self._dead:
+            prev_id, next_id, _ = self._links.pop(self._dead.popleft().key)
+            if prev_id is not None:
+                self._links[prev_id][1] = next_id
+            if next_id is not None:
+                self._links[next_id][0] = prev_id
+            else:
+                self._last_live = prev_id
+
+    def _linked(self, version_id, direction):
+        """ Соседняя живая версия в списке WEAK: direction 0 - предыдущая, 1 - следующая """
+
+        with self._lock:
+            self._unlink_dead()
+            link = self._links.get(version_id)
+            while link is not None and link[direction] is not None:
+                link = self._links[link[direction]]
+                # версия могла умереть, а callback еще не сработал
+                version = link[2]()
+                if version is not None:
+                    return version
+        return None
+
+    def previous(self, version_id):
+        """ Ближайшая сохраненная версия до version_id или None """
+
+        if version_id is None or self._policy == self.OFF:
+            return None
+        if self._policy == self.WEAK:
+            return self._linked(version_id, 0)
+
+        first_id = self._first_id()
+        for i in range(version_id - 1, first_id - 1, -1):
+            version = self._versions.get(i)
+            if version is not None:
+                return version
+        return None
+
+    def next(self, version_id):
+        """ Ближайшая сохраненная версия после version_id или None """
+
+        if version_id is None or self._policy == self.OFF:
+            return None
+        if self._policy == self.WEAK:
+            return self._linked(version_id, 1)
+
+        for i in range(version_id + 1, self._last_id + 1):
+            version = self._versions.get(i)
+            if version is not None:
+                return version
+        return None
+
+    def __len__(self):
+        return len(self._versions)
+
+    def __iter__(self):
+        for _, version in sorted(self._versions.items(), key=operator.itemgetter(0)):
+            yield version
+
+
 class PythonPVector(object):
+    """
+        Персистентный вектор на 32-ичном префиксном дереве.
+
+        Потокобезопасность: содержимое готового вектора не меняется, поэтому чтение и создание
+        новых версий из разных потоков не требует блокировок, id версий выдаются атомарным
+        itertools.count. Буфер хвоста общий для версий и дописывается на месте (append), но каждая
+        версия читает только свой префикс буфера, а запись в чужой префикс не делается никогда.
+        Evolver - изменяемый объект для одного потока
+    """
 
-    __slots__ = ('_count', '_shift', '_root', '_tail', '_tail_offset', '_versions', '__weakref__')
+    __slots__ = ('_count', '_shift', '_root', '_tail', '_tail_offset', '_versions', '_version_id',
+                 '_cached_hash', '_focus', '__weakref__')
 
-    def __new__(cls, count, shift, root, tail, versions):
+    def __new__(cls, count, shift, root, tail, versions, tail_offset=None):
         self = super(PythonPVector, cls).__new__(cls)
         self._count = count
         self._shift = shift # 5 for empty
         self._root = root
         self._tail = tail
-        self._versions = versions + [self]
+        # общая для семейства история версий (VersionHistory)
+        self._versions = versions
+        # id в истории, None для промежуточных векторов
+        self._version_id = None
+        self._cached_hash = None
+        # последний найденный лист дерева: (start, end, leaf), кортеж заменяется атомарно
+        self._focus = _NO_FOCUS
 
         # кол-во элементов в вереве (не учитываем элементы в хвосте)
-        self._tail_offset = self._count - len(self._tail)
+        # буфер хвоста может быть длиннее: его продолжают более новые версии (см. append)
+        self._tail_offset = self._count - len(self._tail) if tail_offset is None else tail_offset
         return self
 
     def __len__(self):
@@ -44,24 +678,103 @@ class PythonPVector(object):
             if index.start is None and index.stop is None and index.step is None:
                 return self
 
-            new_v = PythonPVector(0, SHIFT, [], [], self._versions)
-            self._save_version(new_v)
+            start, stop, step = index.indices(self._count)
+            if step == 1:
+                # непрерывный срез - разделяет листья и поддеревья с исходным вектором
+                return self._save_version(self._slice(start, max(start, stop)))
 
-            return new_v.extend(self.tolist()[index])
+            new_v = PythonPVector(0, SHIFT, [], self._tail[:0], self._versions)
+            l = self.tolist()[index]
+            return new_v.extend(l) if l else self._save_version(new_v)
 
         if index < 0:
             index += self._count
 
-        return PythonPVector._node_for(self, index)[index & BIT_MASK]
+        # соседние обращения попадают в тот же лист - без спуска по дереву
+        start, end, leaf = self._focus
+        if start <= index < end:
+            return leaf[index - start]
+
+        node, i = PythonPVector._leaf_for(self, index)
+        if index < self._tail_offset:
+            # хвост и так доступен сразу, запоминаем только листья дерева
+            self._focus = (index - i, index - i + len(node), node)
+        return node[i]
+
+    def _slice(self, start, stop):
+        """ Срез [start, stop) за O(log n) """
+
+        if start == stop:
+            return PythonPVector(0, SHIFT, [], self._tail[:0], self._versions)
+
+        root, shift = self._root, self._shift
+        tree_size = self._tail_offset
+
+        # отрезаем все после stop: лист с элементом stop - 1 становится хвостом
+        if stop > tree_size:
+            tail = self._tail[:stop - tree_size]
+        else:
+            leaf, i = PythonPVector._leaf_for(self, stop - 1)
+            tail = leaf[:i + 1]
+            tree_size = stop - len(tail)
+            root = _take(root, shift, tree_size) if tree_size else []
+
+        # отрезаем все до start: левый край дерева становится relaxed
+        if start >= tree_size:
+            tail = tail[start - tree_size:]
+            root, tree_size = [], 0
+        elif start:
+            root = _drop(root, shift, start)
+            tree_size -= start
+
+        if not tree_size:
+            shift = SHIFT
+
+        # убираем лишние уровни
+        while shift > SHIFT and len(root) == 1:
+            root = root[0]
+            shift -= SHIFT
+
+        return PythonPVector(tree_size + len(tail), shift, root, tail, self._versions)
 
     def __add__(self, other):
         return self.extend(other)
 
     def __iter__(self):
-        return iter(self.tolist())
+        return chain.from_iterable(self._iter_leaves())
+
+    def __reversed__(self):
+        return chain.from_iterable(map(reversed, self._iter_leaves_reversed()))
+
+    def _iter_leaves(self):
+        """ Ленивый обход листьев дерева, затем хвоста """
+
+        return chain(_leaves(self._root, self._shift), (self._tail_copy(),))
+
+    def _iter_leaves_reversed(self):
+        return chain((self._tail_copy(),), _reversed_leaves(self._root, self._shift))
+
+    def _tail_copy(self):
+        """
+            Копия хвоста в границах вектора. Буфер хвоста общий для версий и может быть
+            продолжен на месте (append) в любой момент, поэтому хвост, который читается лениво
+            или уходит в дерево, всегда копируется (срез атомарен)
+        """
+        return self._tail[:self._count - self._tail_offset]
+
+    def _iter_from(self, start):
+        """ Поток элементов начиная с индекса start, целые листья до start пропускаются """
+
+        offset = 0
+        leaves = self._iter_leaves()
+        for leaf in leaves:
+            if offset + len(leaf) > start:
+                return chain(islice(leaf, start - offset, None), chain.from_iterable(leaves))
+            offset += len(leaf)
+        return iter(())
 
     def _save_version(self, new):
-        self._versions.append(new)
+        new._version_id = self._versions.add(new)
         return new
 
     def _fill_list(self, node, shift, the_list):
@@ -74,40 +787,125 @@ class PythonPVector(object):
         else:
             the_list.extend(node)
 
+    def to_numpy(self, dtype=None):
+        """
+            Массив numpy: выход выделяется один раз, типизированные листья копируются
+            целиком через буфер
+        """
+        import numpy
+
+        if dtype is None:
+            if self.typecode is None:
+                return numpy.array(self.tolist())
+            dtype = numpy.dtype(self.typecode)
+
+        out = numpy.empty(self._count, dtype=dtype)
+        pos = 0
+        for leaf in self._iter_leaves():
+            n = len(leaf)
+            if type(leaf) is array and numpy.dtype(leaf.typecode) == out.dtype:
+                out[pos:pos + n] = numpy.frombuffer(leaf, dtype=out.dtype)
+            else:
+                out[pos:pos + n] = leaf
+            pos += n
+        return out
+
+    def take(self, indices):
+        """ Вектор из элементов по индексам (как numpy.take), для соседних индексов лист ищется один раз """
+
+        values = []
+        leaf, start, end = None, 0, 0
+        for i in indices:
+            if not isinstance(i, Integral):
+                raise TypeError("Not index")
+
+            index = int(i) + self._count if i < 0 else int(i)
+            if not start <= index < end:
+                if not 0 <= index < self._count:
+                    raise IndexError("Index out of range: %s" % (i,))
+                leaf, pos = PythonPVector._leaf_for(self, index)
+                start = index - pos
+                end = min(start + len(leaf), self._count)
+            values.append(leaf[index - start])
+
+        new_v = PythonPVector(0, SHIFT, [], self._tail[:0], self._versions)
+        return new_v.extend(values) if values else self._save_version(new_v)
+
     def tolist(self):
         the_list = []
         self._fill_list(self._root, self._shift, the_list)
-        the_list.extend(self._tail)
+        the_list.extend(self._tail_copy())
         return the_list
 
     def _totuple(self):
-        return tuple(self.tolist())
+        return tuple(self)
 
     def __str__(self):
-        return str(self.tolist())
+        return '[' + ', '.join(map(repr, self)) + ']'
 
     def __repr__(self):
-        return str(self.tolist())
+        return self.__str__()
 
     def __hash__(self):
-        return hash(self._totuple())
+        # хеш tuple (xxHash) потоком, вектор неизменяемый - вычисляем один раз
+        if self._cached_hash is None:
+            self._cached_hash = _hash_sequence(self, self._count)
+        return self._cached_hash
+
+    def __eq__(self, other):
+        if isinstance(other, PythonPVector):
+            return _pvector_equal(self, other)
+        return compare_pvector(self, other, operator.eq)
+
+    def __ne__(self, other):
+        if isinstance(other, PythonPVector):
+            return not _pvector_equal(self, other)
+        return compare_pvector(self, other, operator.ne)
+
+    def __lt__(self, other):
+        return compare_pvector(self, other, operator.lt)
+
+    def __le__(self, other):
+        return compare_pvector(self, other, operator.le)
+
+    def __gt__(self, other):
+        return compare_pvector(self, other, operator.gt)
+
+    def __ge__(self, other):
+        return compare_pvector(self, other, operator.ge)
 
     def undo(self):
         """ Возвращает предыдущую версию вектора """
-        curr_index = self._versions.index(self)
-        curr_index = max(0, curr_index - 1)
-        undo_version = self._versions[curr_index]
-        undo_version._versions = self._versions
-        return undo_version
+        version = self._versions.previous(self._version_id)
+        return self if version is None else version
 
     def redo(self):
         """ Возвращает следующую версию вектора """
+        version = self._versions.next(self._version_id)
+        return self if version is None else version
 
-        curr_index = self._versions.index(self)
-        curr_index = min(len(self._versions) - 1, curr_index + 1)
-        return self._versions[curr_index]
+    @property
+    def typecode(self):
+        """ Код типа array.array для типизированного вектора, None для обычного """
+        return self._tail.typecode if type(self._tail) is array else None
+
+    @property
+    def version_id(self):
+        return self._version_id
+
+    def checkout(self, version_id):
+        """ Переход к любой сохраненной версии семейства по ее id """
+
+        version = self._versions.get(version_id)
+        if version is None:
+            raise KeyError("Version is not retained: %s" % (version_id,))
+        return version
 
     def versions(self):
+        """ Сохраненные версии семейства """
+        return list(self._versions)
+
+    def history(self):
         return self._versions
 
     def set(self, i, val):
@@ -124,9 +922,9 @@ class PythonPVector(object):
         if 0 <= i < self._count:
             if i >= self._tail_offset:
                 # если элемент для обновления в хвосте
-                new_tail = list(self._tail)
+                new_tail = self._tail_copy()
                 # обновляем tail
-                new_tail[i & BIT_MASK] = val
+                new_tail[i - self._tail_offset] = val
                 # создаем новый вектор
                 return self._save_version(PythonPVector(self._count,
                                                         self._shift,
@@ -138,7 +936,8 @@ class PythonPVector(object):
                                                     self._shift,
                                                     self._do_set(self._shift, self._root, i, val),
                                                     self._tail,
-                                                    self._versions))
+                                                    self._versions,
+                                                    self._tail_offset))
 
         # добавление в конец
         if i == self._count:
@@ -151,8 +950,15 @@ class PythonPVector(object):
             Обновление элемента в дереве
         """
 
+        if type(node) is _RelaxedNode:
+            # в relaxed ноде ищем потомка по таблице размеров, индекс становится относительным
+            sub_index, offset = _relaxed_index(node, i, level)
+            ret = _relaxed(node, node.sizes)
+            ret[sub_index] = self._do_set(level - SHIFT, node[sub_index], i - offset, val)
+            return ret
+
         # копируем ноду
-        ret = list(node)
+        ret = node[:]
         if level == 0:
             ret[i & BIT_MASK] = val
         else:
@@ -162,20 +968,130 @@ class PythonPVector(object):
 
         return ret
 
+    def mset(self, *args):
+        """ Пакетное обновление mset(i1, v1, i2, v2, ...), одна новая версия """
+
+        if len(args) % 2:
+            raise TypeError("mset expected an even number of arguments")
+        return self._set_items(zip(args[::2], args[1::2]))
+
+    def set_many(self, updates):
+        """ Пакетное обновление по словарю {индекс: значение} или парам (индекс, значение) """
+
+        return self._set_items(updates.items() if hasattr(updates, 'items') else updates)
+
+    def put(self, indices, values):
+        """ Векторизованное обновление (как numpy.put): массивы индексов и значений одной длины """
+
+        indices = list(indices)
+        values = list(values)
+        if len(indices) != len(values):
+            raise ValueError("indices and values have different lengths: %s != %s" % (len(indices), len(values)))
+        return self._set_items(zip(indices, values))
+
+    def _set_items(self, pairs):
+        """ Обновление элементов за один проход по дереву """
+
+        updates = {}
+        for i, val in pairs:
+            if not isinstance(i, Integral):
+                raise TypeError("Not index")
+
+            index = int(i) + self._count if i < 0 else int(i)
+            if not 0 <= index < self._count:
+                raise IndexError("Index out of range: %s" % (i,))
+            # для повторного индекса остается последнее значение
+            updates[index] = val
+
+        if not updates:
+            return self
+
+        items = sorted(updates.items(), key=operator.itemgetter(0))
+
+        # элементы из хвоста обновляем в копии хвоста
+        tree_count = len(items)
+        while tree_count and items[tree_count - 1][0] >= self._tail_offset:
+            tree_count -= 1
+
+        tail = self._tail
+        if tree_count < len(items):
+            tail = self._tail_copy()
+            for i, val in items[tree_count:]:
+                tail[i - self._tail_offset] = val
+
+        root = self._root
+        if tree_count:
+            root = self._do_set_many(self._shift, root, items, 0, tree_count, 0)
+
+        return self._save_version(PythonPVector(self._count, self._shift, root, tail, self._versions,
+                                                self._tail_offset))
+
+    def _do_set_many(self, level, node, items, lo, hi, base):
+        """
+            Обновление элементов items[lo:hi] (пары (индекс, значение) по возрастанию индекса,
+            base - индекс начала поддерева), каждая нода пути копируется один раз
+        """
+        relaxed = type(node) is _RelaxedNode
+        ret = _relaxed(node, node.sizes) if relaxed else node[:]
+
+        if level == 0:
+            for k in range(lo, hi):
+                i, val = items[k]
+                ret[i - base] = val
+            return ret
+
+        k = lo
+        while k < hi:
+            # группа элементов, попадающих в одного потомка
+            i = items[k][0] - base
+            if relaxed:
+                sub_index, offset = _relaxed_index(node, i, level)
+                end = node.sizes[sub_index]
+            else:
+                sub_index = (i >> level) & BIT_MASK  # >>>
+                offset = sub_index << level
+                end = offset + (1 << level)
+
+            j = k + 1
+            while j < hi and items[j][0] - base < end:
+                j += 1
+
+            ret[sub_index] = self._do_set_many(level - SHIFT, node[sub_index], items, k, j, base + offset)
+            k = j
+
+        return ret
+
     @staticmethod
-    def _node_for(pvector_like, i):
+    def _leaf_for(pvector_like, i):
         """
-            Поиск node для элемента с индексом i
+            Поиск листа для элемента с индексом i, возвращает (лист, индекс в листе)
         """
         if 0 <= i < pvector_like._count:
             if i >= pvector_like._tail_offset:
-                return pvector_like._tail
+                return pvector_like._tail, i - pvector_like._tail_offset
 
             node = pvector_like._root
-            for level in range(pvector_like._shift, 0, -SHIFT):
+            level = pvector_like._shift
+            # плотное дерево - переход по битам индекса
+            while level and type(node) is not _RelaxedNode:
                 node = node[(i >> level) & BIT_MASK]  # >>>
+                level -= SHIFT
 
-            return node
+            if not level:
+                return node, i & BIT_MASK
+
+            # relaxed дерево - переход по таблицам размеров до первой плотной ноды
+            while level and type(node) is _RelaxedNode:
+                sub_index, offset = _relaxed_index(node, i, level)
+                node = node[sub_index]
+                i -= offset
+                level -= SHIFT
+
+            while level:
+                node = node[(i >> level) & BIT_MASK]
+                level -= SHIFT
+
+            return node, i & BIT_MASK
 
         raise IndexError("Index out of range: %s" % (i,))
 
@@ -183,6 +1099,17 @@ class PythonPVector(object):
         """ Создание нового root """
 
         new_shift = self._shift
+        # в дерево уходит только свой префикс буфера: проигравший гонку поток (см. append)
+        # мог дописать в буфер элемент за границей этого вектора
+        tail = self._tail_copy()
+
+        if type(self._root) is _RelaxedNode:
+            new_root = _push_leaf(self._root, self._shift, tail)
+            if new_root is None:
+                # в relaxed дереве нет места - новый уровень
+                new_root = _make_node([self._root, _new_path(self._shift, tail)], self._shift + SHIFT)
+                new_shift += SHIFT
+            return new_root, new_shift
 
         # root overflow, надо создать новый уровень дерева
         # count > (2 ^ _shift)
@@ -190,11 +1117,11 @@ class PythonPVector(object):
         # 32 ноды в root, по 32 элемента в каждой ноде + 32 в tail
         if (self._count >> SHIFT) > (1 << self._shift):
             # создаем новый root и подвещиваем старый root первым потомком, копируем путь
-            new_root = [self._root, self._new_path(self._shift, self._tail)]
+            new_root = [self._root, _new_path(self._shift, tail)]
             new_shift += SHIFT
         else:
             # 1) в tail закончилось место, кладем элементы из tail в root, новый элемент будет в tail
-            new_root = self._push_tail(self._shift, self._root, self._tail)
+            new_root = self._push_tail(self._shift, self._root, tail)
 
         return new_root, new_shift
 
@@ -202,10 +1129,34 @@ class PythonPVector(object):
         """ Добавление элемента в конец """
 
         # есть место в tail?
-        if len(self._tail) < BRANCH_FACTOR:
+        tail_len = self._count - self._tail_offset
+        if tail_len < BRANCH_FACTOR:
             # ускорение за счет отказа от копирования пути при добавлении нового элемента
-            # добавляем новый элемент в tail
-            new_tail = list(self._tail)
+            tail = self._tail
+            if len(tail) == tail_len:
+                # буфер хвоста никто не продолжил - дописываем на месте, старые версии
+                # видят только свой префикс буфера (count ограничивает все чтения хвоста)
+                # другой поток мог дописать в буфер раньше нас: элемент tail_len должен быть нашим
+                if type(tail) is array:
+                    # array хранит приведенное значение (float32, NaN, большие int в 'd') -
+                    # сравниваем байты записанного нами элемента с тем, что лежит в буфере
+                    item = tail[:0]
+                    item.append(val)
+                    tail.extend(item)
+                    owned = tail[tail_len:tail_len + 1].tobytes() == item.tobytes()
+                else:
+                    tail.append(val)
+                    owned = tail[tail_len] is val
+                if owned:
+                    return self._save_version(PythonPVector(self._count + 1,
+                                                            self._shift,
+                                                            self._root,
+                                                            tail,
+                                                            self._versions,
+                                                            self._tail_offset))
+
+            # буфер уже продолжен другой версией - копируем свой префикс
+            new_tail = tail[:tail_len]
             new_tail.append(val)
             return self._save_version(PythonPVector(self._count + 1,
                                                     self._shift,
@@ -214,28 +1165,17 @@ class PythonPVector(object):
                                                     self._versions))
 
         # в tail нет места - добавляем элементы в root или создаем новый уровень дерева
-        # новый элемент кладем в tail
+        # новый элемент кладем в tail (того же типа, list или array)
         new_root, new_shift = self._create_new_root()
+        new_tail = self._tail[:0]
+        new_tail.append(val)
         return self._save_version(PythonPVector(self._count + 1,
                                                 new_shift,
                                                 new_root,
-                                                [val],
+                                                new_tail,
                                                 self._versions
                                                 ))
 
-    def _new_path(self, level, node):
-        # 1) _shift, _tail
-        if level == 0:
-            return node
-
-        return [self._new_path(level - SHIFT, node)]
-
-    def _mutating_insert_tail(self):
-        """ Создаем рут или новый уровень при переполнении tail"""
-
-        self._root, self._shift = self._create_new_root()
-        self._tail = []
-
     def _mutating_fill_tail(self, offset, sequence):
         """ Заполняем tail не создавая новую версию """
 
@@ -247,28 +1187,148 @@ class PythonPVector(object):
         return offset + delta_len
 
     def _mutating_extend(self, sequence):
-        offset = 0
-        sequence_len = len(sequence)
-        while offset < sequence_len:
-            offset = self._mutating_fill_tail(offset, sequence)
-            if len(self._tail) == BRANCH_FACTOR:
-                self._mutating_insert_tail()
+        """ Добавление элементов без создания новой версии, дерево достраивается снизу вверх """
 
+        offset = self._mutating_fill_tail(0, sequence)
+        if len(self._tail) < BRANCH_FACTOR:
+            self._tail_offset = self._count - len(self._tail)
+            return
+
+        # хвост полон: он и полные листья из sequence уходят в дерево одним проходом
+        dense = type(self._root) is not _RelaxedNode
+        builder = _TrieBuilder(self._root, self._shift, self._tail_offset) if dense else _TrieBuilder()
+        builder.add_leaf(self._tail)
+
+        empty = self._tail[:0]
+        sequence_len = len(sequence)
+        leaves_end = offset + ((sequence_len - offset) >> SHIFT << SHIFT)
+        for k in range(offset, leaves_end, BRANCH_FACTOR):
+            builder.add_leaf(_as_leaf(empty, sequence[k:k + BRANCH_FACTOR]))
+
+        root, shift = builder.root()
+        if not dense:
+            # relaxed дерево не продолжить по правому краю - склеиваем с новым плотным
+            root, shift = _concat_trees(self._root, self._shift, root, shift)
+
+        self._root, self._shift = root, shift
+        self._count += leaves_end - offset
+        self._tail = _as_leaf(empty, sequence[leaves_end:])
+        self._count += len(self._tail)
         self._tail_offset = self._count - len(self._tail)
 
     def extend(self, obj):
         """ Добавление нескольких элементов в вектор """
 
-        l = obj.tolist() if isinstance(obj, PythonPVector) else list(obj)
+        if isinstance(obj, PythonPVector):
+            return self.concat(obj)
+
+        # array другого typecode не дописать в хвост через array.extend - перекладываем в list
+        same_kind = type(obj) is array and (type(self._tail) is list or obj.typecode == self._tail.typecode)
+        l = obj if type(obj) is list or same_kind else list(obj)
         if l:
-            # создаем новый вектор с одним элементом (новая версия)
-            # добавляем остальные элементы из obj без изменения версии
-            new_vector = self.append(l[0])
-            new_vector._mutating_extend(l[1:])
-            return new_vector
+            # новая версия: хвост копируем, остальное достраиваем без изменения версии
+            new_vector = PythonPVector(self._count, self._shift, self._root, self._tail_copy(), self._versions)
+            new_vector._mutating_extend(l)
+            return self._save_version(new_vector)
 
         return self
 
+    def concat(self, other):
+        """ Конкатенация векторов за O(log n), листья и поддеревья обоих векторов разделяются """
+
+        if not other._count:
+            return self
+        return self._save_version(self._concat(other))
+
+    def _concat(self, other):
+        """ Конкатенация без создания новой версии """
+
+        if not other._count:
+            return self
+        if self.typecode != other.typecode:
+            # листья другого типа не разделяются - перекладываем элементы, как extend(list),
+            # результат получает typecode левого вектора
+            new_v = PythonPVector(self._count, self._shift, self._root, self._tail_copy(), self._versions)
+            new_v._mutating_extend(other.tolist())
+            return new_v
+        if not self._count:
+            return PythonPVector(other._count, other._shift, other._root, other._tail, self._versions,
+                                 other._tail_offset)
+
+        tail = self._tail_copy()
+        if not other._tail_offset:
+            # у other только хвост - дописываем его поэлементно, дерево остается плотным
+            new_v = PythonPVector(self._count, self._shift, self._root, tail, self._versions)
+            new_v._mutating_extend(other._tail_copy())
+            return new_v
+
+        # хвост становится листом дерева
+        if len(tail) == BRANCH_FACTOR:
+            root, shift = self._create_new_root()
+        elif not tail:
+            root, shift = self._root, self._shift
+        else:
+            # неполный лист - склеиваем как relaxed дерево из одного листа
+            leaf_root = _make_node([tail], SHIFT)
+            if self._tail_offset:
+                root, shift = _concat_trees(self._root, self._shift, leaf_root, SHIFT)
+            else:
+                root, shift = leaf_root, SHIFT
+
+        root, shift = _concat_trees(root, shift, other._root, other._shift)
+        return PythonPVector(self._count + other._count, shift, root, other._tail, self._versions,
+                             self._count + other._tail_offset)
+
+    def insert(self, i, val):
+        """ Вставка элемента перед индексом i за O(log n) """
+
+        return self._save_version(self._insert(i, val))
+
+    def _insert(self, i, val):
+        """ insert без создания новой версии """
+
+        if not isinstance(i, Integral):
+            raise TypeError("Not index")
+
+        if i < 0:
+            i += self._count
+        # как у list.insert: индекс за границами прижимается к краю
+        i = min(max(i, 0), self._count)
+
+        if i >= self._tail_offset and self._count - self._tail_offset < BRANCH_FACTOR:
+            # вставка в хвост с местом - дерево не меняется
+            new_tail = self._tail_copy()
+            new_tail.insert(i - self._tail_offset, val)
+            return PythonPVector(self._count + 1, self._shift, self._root, new_tail, self._versions)
+
+        left = self._slice(0, i)
+        left._mutating_extend([val])
+        return left._concat(self._slice(i, self._count))
+
+    def delete(self, i):
+        """ Удаление элемента по индексу за O(log n) """
+
+        return self._save_version(self._delete(i))
+
+    def _delete(self, i):
+        """ delete без создания новой версии """
+
+        if not isinstance(i, Integral):
+            raise TypeError("Not index")
+
+        if i < 0:
+            i += self._count
+
+        if not 0 <= i < self._count:
+            raise IndexError("Index out of range: %s" % (i,))
+
+        if i >= self._tail_offset and (self._count - self._tail_offset > 1 or not self._tail_offset):
+            new_tail = self._tail_copy()
+            del new_tail[i - self._tail_offset]
+            return PythonPVector(self._count - 1, self._shift, self._root, new_tail, self._versions)
+
+        return self._slice(0, i)._concat(self._slice(i + 1, self._count))
+
     def _push_tail(self, level, parent, tail_node):
         # 1: _shift, _root, _tail
 
@@ -291,142 +1351,319 @@ class PythonPVector(object):
             return ret
 
         # копируем путь
-        ret.append(self._new_path(level - SHIFT, tail_node))
+        ret.append(_new_path(level - SHIFT, tail_node))
         return ret
 
-    def index(self, value, *args, **kwargs):
+    def index(self, value, start=0, stop=None):
         """ Индекс элемента в векторе """
 
-        return self.tolist().index(value, *args, **kwargs)
+        start, stop, _ = slice(start, stop).indices(self._count)
+        for i, x in zip(range(start, stop), self._iter_from(start)):
+            if x is value or x == value:
+                return i
+
+        raise ValueError("%r is not in pvector" % (value,))
 
     def count(self, value):
         """ Количество элементов в веторе равных value """
 
-        return self.tolist().count(value)
+        return sum(1 for x in self if x is value or x == value)
 
     def remove(self, value):
-        """ Удаление элемента """
+        """ Удаление первого элемента равного value: поиск потоком по листьям, затем delete """
+
+        return self.delete(self.index(value))
 
-        l = self.tolist()
-        l.remove(value)
-        new_v = PythonPVector(0, SHIFT, [], [], self._versions)
-        self._save_version(new_v)
-        return new_v.extend(l)
+    def pop(self, i=-1):
+        """ Вектор без элемента по индексу (по умолчанию последнего) """
+
+        if not self._count:
+            raise IndexError("pop from empty pvector")
+        return self.delete(i)
 
     # Evolver for pmap
 
     class Evolver(object):
-        __slots__ = ('_count', '_shift', '_root', '_tail', '_tail_offset', '_dirty_nodes',
-                     '_extra_tail', '_cached_leafs', '_orig_pvector')
-        # TODO add tests for Evolver
+        """
+            Изменяемая (transient) версия вектора для пакетных изменений.
+
+            Ноды, скопированные evolver'ом, принадлежат ему и меняются на месте. Владение -
+            словарь id -> нода: он держит ссылки на свои ноды, поэтому id не может достаться
+            чужой ноде. persistent() и любой снимок состояния заменяют словарь новым, после
+            этого отданные ноды больше не меняются
+        """
+        __slots__ = ('_count', '_shift', '_root', '_tail', '_tail_offset', '_owned',
+                     '_cached_leafs', '_orig_pvector')
 
         def __init__(self, v):
             self._reset(v)
 
-        def __getitem__(self, index):
-            if not isinstance(index, Integral):
-                raise TypeError("'%s' object cannot be interpreted as an index" % type(index).__name__)
-
-            if index < 0:
-                index += self._count + len(self._extra_tail)
-
-            if self._count <= index < self._count + len(self._extra_tail):
-                return self._extra_tail[index - self._count]
+        def _reset(self, v):
+            self._orig_pvector = v
+            self._set_state(v)
 
-            return PythonPVector._node_for(self, index)[index & BIT_MASK]
+        def _set_state(self, v):
+            """ Новое состояние evolver'а из вектора, ноды вектора чужие """
 
-        def _reset(self, v):
             self._count = v._count
             self._shift = v._shift
             self._root = v._root
             self._tail = v._tail
             self._tail_offset = v._tail_offset
-            self._dirty_nodes = {}
+            self._owned = {}
+            # лист по номеру (index >> SHIFT), только для плотного дерева
             self._cached_leafs = {}
-            self._extra_tail = [] # для новых элементов
-            self._orig_pvector = v
 
-        def extend(self, iterable):
-            self._extra_tail.extend(iterable)
-            return self
+        def _snapshot(self):
+            """ Текущее состояние как вектор без версии, ноды перестают принадлежать evolver'у """
 
-        def __setitem__(self, index, val):
+            self._owned = {}
+            self._cached_leafs = {}
+            return PythonPVector(self._count, self._shift, self._root, self._tail,
+                                 self._orig_pvector.history(), self._tail_offset)
+
+        def _own(self, node):
+            self._owned[id(node)] = node
+            return node
+
+        def _owns(self, node):
+            return self._owned.get(id(node)) is node
+
+        def _own_tail(self):
+            if not self._owns(self._tail):
+                self._tail = self._own(PythonPVector._tail_copy(self))
+
+        def _normalize(self, index):
             if not isinstance(index, Integral):
                 raise TypeError("'%s' object cannot be interpreted as an index" % type(index).__name__)
 
-            if index < 0:
-                index += self._count + len(self._extra_tail)
+            return index + self._count if index < 0 else index
+
+        def __getitem__(self, index):
+            if isinstance(index, slice):
+                return self._snapshot()[index]
+
+            index = self._normalize(index)
+            node, i = PythonPVector._leaf_for(self, index)
+            return node[i]
+
+        def __setitem__(self, index, val):
+            if isinstance(index, slice):
+                self._set_slice(index, val)
+                return
+
+            index = self._normalize(index)
 
             if 0 <= index < self._count:
-                # получаем node для индекса из кеша
+                if index >= self._tail_offset:
+                    # если элемент для обновления в хвосте
+                    self._own_tail()
+                    self._tail[index - self._tail_offset] = val
+                    return
+
+                # получаем лист для индекса из кеша
                 node = self._cached_leafs.get(index >> SHIFT)
-                if node:
+                if node is not None:
                     node[index & BIT_MASK] = val
-                elif index >= self._tail_offset:
-                    # если элемент для обновления в хвосте
-                    if id(self._tail) not in self._dirty_nodes:
-                        # создаем новый _tail, помечаем как измененный
-                        self._tail = list(self._tail)
-                        self._dirty_nodes[id(self._tail)] = True
-                        self._cached_leafs[index >> SHIFT] = self._tail
-                    self._tail[index & BIT_MASK] = val
                 else:
                     # элемент в дереве, алгоритм как для pvector _do_set
                     self._root = self._do_set(self._shift, self._root, index, val)
-            elif self._count <= index < self._count + len(self._extra_tail):
-                # элемент находиться в _extra_tail
-                self._extra_tail[index - self._count] = val
-            elif index == self._count + len(self._extra_tail):
+            elif index == self._count:
                 # элемента нет в структуре
-                self._extra_tail.append(val)
+                self.append(val)
             else:
                 raise IndexError("Index out of range: %s" % (index,))
 
+        def set(self, index, val):
+            self[index] = val
+            return self
+
         def _do_set(self, level, node, i, val):
             """
-                _do_set как в pvector
+                _do_set как в pvector, свои ноды меняются на месте
             """
-            # помечаем ноду как измененную
-            if id(node) in self._dirty_nodes:
+            if self._owns(node):
                 ret = node
             else:
                 # делаем копию ноды
-                ret = list(node)
-                self._dirty_nodes[id(ret)] = True
+                ret = self._own(_relaxed(node, node.sizes) if type(node) is _RelaxedNode else node[:])
 
-            if level == 0:
+            if type(node) is _RelaxedNode:
+                sub_index, offset = _relaxed_index(node, i, level)
+                ret[sub_index] = self._do_set(level - SHIFT, node[sub_index], i - offset, val)
+            elif level == 0:
                 ret[i & BIT_MASK] = val
-                self._cached_leafs[i >> SHIFT] = ret
+                if type(self._root) is list:
+                    self._cached_leafs[i >> SHIFT] = ret
             else:
                 sub_index = (i >> level) & BIT_MASK  # >>>
                 ret[sub_index] = self._do_set(level - SHIFT, node[sub_index], i, val)
 
             return ret
 
+        def _push_tail(self):
+            """ Полный хвост уходит в дерево, новый хвост пустой и свой """
+
+            empty_tail = self._tail[:0]
+            tail_vector = PythonPVector(self._count, self._shift, self._root, self._tail, None, self._tail_offset)
+            self._root, self._shift = tail_vector._create_new_root()
+            self._tail_offset = self._count
+            self._tail = self._own(empty_tail)
+
+        def append(self, val):
+            if self._count - self._tail_offset == BRANCH_FACTOR:
+                self._push_tail()
+            else:
+                self._own_tail()
+
+            self._tail.append(val)
+            self._count += 1
+            return self
+
+        def extend(self, iterable):
+            values = list(iterable)
+            offset = 0
+            # заполняем хвост на месте кусками до BRANCH_FACTOR элементов
+            while offset < len(values):
+                if self._count - self._tail_offset == BRANCH_FACTOR:
+                    self._push_tail()
+                else:
+                    self._own_tail()
+
+                delta = values[offset:offset + BRANCH_FACTOR - len(self._tail)]
+                self._tail.extend(delta)
+                self._count += len(delta)
+                offset += len(delta)
+
+            return self
+
+        def insert(self, index, val):
+            self._set_state(self._snapshot()._insert(index, val))
+            return self
+
+        def delete(self, index):
+            index = self._normalize(index)
+            if self._tail_offset <= index < self._count and self._count - self._tail_offset > 1:
+                # удаление из хвоста на месте
+                self._own_tail()
+                del self._tail[index - self._tail_offset]
+                self._count -= 1
+                return self
+
+            self._set_state(self._snapshot()._delete(index))
+            return self
+
+        def __delitem__(self, index):
+            if not isinstance(index, slice):
+                self.delete(index)
+                return
+
+            start, stop, step = index.indices(self._count)
+            if step == 1:
+                if start < stop:
+                    v = self._snapshot()
+                    self._set_state(v._slice(0, start)._concat(v._slice(stop, self._count)))
+                return
+
+            # удаляем с конца, чтобы индексы оставшихся не сдвигались
+            for i in sorted(range(start, stop, step), reverse=True):
+                self.delete(i)
+
+        def _set_slice(self, index, values):
+            start, stop, step = index.indices(self._count)
+            values = list(values)
+
+            if step == 1:
+                v = self._snapshot()
+                left = v._slice(0, start)
+                left._mutating_extend(values)
+                self._set_state(left._concat(v._slice(max(start, stop), self._count)))
+                return
+
+            indices = range(start, stop, step)
+            if len(indices) != len(values):
+                raise ValueError("attempt to assign sequence of size %s to extended slice of size %s"
+                                 % (len(values), len(indices)))
+            for i, val in zip(indices, values):
+                self[i] = val
+
+        def pop(self, index=-1):
+            """ Удаляет элемент и возвращает его, как list.pop """
+
+            if not self._count:
+                raise IndexError("pop from empty evolver")
+
+            val = self[index]
+            self.delete(index)
+            return val
+
+        def remove(self, value):
+            return self.delete(self._snapshot().index(value))
+
         def persistent(self):
-            result = self._orig_pvector
+            """ Вектор из текущего состояния за O(1): ноды не копируются, а перестают быть своими """
 
-            # если evolver был модифицирован
             if self.is_dirty():
-                result = PythonPVector(self._count, self._shift, self._root, self._tail, self._orig_pvector.versions()).extend(self._extra_tail)
-                self._reset(result)
+                result = self._snapshot()
+                self._orig_pvector._save_version(result)
+                self._orig_pvector = result
 
-            return result
+            return self._orig_pvector
 
         def __len__(self):
-            return self._count + len(self._extra_tail)
+            return self._count
 
         def is_dirty(self):
             """
                 true, если над evolver производились модификации
             """
-            return bool(self._dirty_nodes or self._extra_tail)
+            orig = self._orig_pvector
+            return self._root is not orig._root or self._tail is not orig._tail or self._count != orig._count
 
     def evolver(self):
         return PythonPVector.Evolver(self)
 
-def pvector(iterable=()):
-    return PythonPVector(0, SHIFT, [], [], []).extend(iterable)
+def pvector(iterable=(), history=None, typecode=None):
+    """
+        Создание вектора, history - VersionHistory нового семейства версий
+        (по умолчанию без ограничений).
+
+        typecode - код типа array.array ('d', 'i', ...): листья и хвост хранятся
+        компактными типизированными массивами вместо list
+    """
+    if history is None:
+        history = VersionHistory()
+
+    empty = PythonPVector(0, SHIFT, [], array(typecode) if typecode is not None else [], history)
+    return empty._save_version(empty).extend(iterable)
+
+
+def from_numpy(arr, history=None):
+    """
+        Вектор из одномерного массива numpy. Числовые dtype хранятся типизированными
+        листьями array.array, данные копируются одним буфером и режутся на листья,
+        дерево строится снизу вверх
+    """
+    if arr.ndim != 1:
+        raise ValueError("Expected one-dimensional array, got %s dimensions" % (arr.ndim,))
+
+    typecode = _numpy_typecode(arr.dtype)
+    flat = array(typecode, arr.tobytes()) if typecode is not None else arr.tolist()
+
+    count = len(flat)
+    # полные листья - в дерево, остаток - в хвост, как после extend
+    tail_offset = (count >> SHIFT) << SHIFT
+    builder = _TrieBuilder()
+    for k in range(0, tail_offset, BRANCH_FACTOR):
+        builder.add_leaf(flat[k:k + BRANCH_FACTOR])
+    root, shift = builder.root()
+
+    if history is None:
+        history = VersionHistory()
+
+    empty = PythonPVector(0, SHIFT, [], flat[:0], history)
+    empty._save_version(empty)
+    return empty._save_version(PythonPVector(count, shift, root, flat[tail_offset:], history))
 
 
 def v(*elements):
@@ -1,8 +1,9 @@
 from unittest import TestCase
-from src.plist import plist
+from src.plist import plist, TREE_ENGINE
 from enum import Enum
 import random
 from functools import partial
+import threading
 
 
 class Operations(Enum):
@@ -175,6 +176,147 @@ class TestPList(TestCase):
         self.assertEqual(len(l2), max_size - 1)
         self.assertEqual(l2.tolist(), ref_list)
 
+    def test_len_cached(self):
+        l = plist()
+        l = TestPList.append_plist(l, 10)
+        l = l.append_front(1).insert(3, 1).remove(0).set(2, 5)
+        self.assertEqual(len(l), 11)
+        self.assertEqual(len(l), len(l.tolist()))
+        self.assertEqual(len(l.undo()), 11)
+        self.assertEqual(len(l.undo().undo()), 12)
+
+    def test_many_branches(self):
+        base = TestPList.append_plist(plist(), 20)
+        branches = []
+        for k in range(300):
+            branches.append((k, base.set(k % 20, -k)))
+
+        for k, branch in branches:
+            ref_list = list(range(20))
+            ref_list[k % 20] = -k
+            self.assertEqual(branch.tolist(), ref_list)
+        self.assertEqual(base.tolist(), list(range(20)))
+
+    def test_threads(self):
+        base = TestPList.append_plist(plist(), 50)
+        results = {}
+        # исключения в потоках не роняют тест сами - собираем их
+        errors = []
+
+        def worker(n):
+            try:
+                l = base
+                for k in range(100):
+                    l = l.set(k % 50, n)
+                    self.assertEqual(l[k % 50], n)
+                    self.assertEqual(base[k % 50], k % 50)
+                results[n] = l
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), 8)
+        self.assertEqual(base.tolist(), list(range(50)))
+        for n, l in results.items():
+            self.assertEqual(l.tolist(), [n] * 50)
+
+    def test_from_iterable(self):
+        l = plist(range(1000))
+        self.assertEqual(l.tolist(), list(range(1000)))
+        self.assertEqual(len(l), 1000)
+        self.assertEqual(l[500], 500)
+        self.assertEqual(len(l.undo()), 0)
+        self.assertEqual(plist([]).tolist(), [])
+
+        l2 = l.append_front(-1).remove(10).insert(3, 'x')
+        ref_list = [-1] + list(range(1000))
+        del ref_list[10]
+        ref_list.insert(3, 'x')
+        self.assertEqual(l2.tolist(), ref_list)
+        self.assertEqual(l.tolist(), list(range(1000)))
+
+    def test_eq_hash(self):
+        l = plist(range(100))
+        l2 = plist(range(99)).append_back(99)
+        self.assertEqual(l, l2)
+        self.assertEqual(hash(l), hash(l2))
+        self.assertEqual(hash(l), hash(tuple(range(100))))
+        self.assertEqual(l, plist(range(100), engine=TREE_ENGINE))
+        self.assertNotEqual(l, l2.set(5, -1))
+        self.assertNotEqual(l, l2.remove(0))
+        self.assertNotEqual(l, list(range(100)))
+
+    def test_append_back_list_one_version(self):
+        base = TestPList.append_plist(plist(), 5)
+        l = base.append_back_list(range(1000))
+        self.assertEqual(l.tolist(), [0, 1, 2, 3, 4] + list(range(1000)))
+        self.assertEqual(len(l), 1005)
+        self.assertEqual(l.undo().tolist(), base.tolist())
+
+    def test_evolver_ends(self):
+        base = TestPList.append_plist(plist(), 3)
+        e = base.evolver()
+        for k in range(10):
+            e.append_back(k)
+            e.append_front(-k)
+        self.assertEqual(len(e), 23)
+        self.assertEqual(e[0], -9)
+        self.assertEqual(e[13], 0)
+
+        l = e.persistent()
+        ref_list = [-k for k in range(9, -1, -1)] + [0, 1, 2] + list(range(10))
+        self.assertEqual(l.tolist(), ref_list)
+        self.assertEqual(base.tolist(), [0, 1, 2])
+        self.assertFalse(e.is_dirty())
+        self.assertIs(e.persistent(), l)
+
+        # ветки от старых версий не видят изменений evolver'а
+        self.assertEqual(base.append_back(7).tolist(), [0, 1, 2, 7])
+        self.assertEqual(l.set(0, 'x').tolist(), ['x'] + ref_list[1:])
+
+    def test_evolver_random(self):
+        random.seed(5)
+        l = plist()
+        ref_list = []
+        snapshots = []
+        for step in range(30):
+            e = l.evolver()
+            for k in range(random.randint(0, 30)):
+                op = TestPList.get_operation()
+                if op == Operations.APPEND_BACK:
+                    e.append_back(k)
+                    ref_list.append(k)
+                elif op == Operations.APPEND_FRONT:
+                    e.append_front(k)
+                    ref_list.insert(0, k)
+                elif op == Operations.INSERT:
+                    index = random.randint(0, len(ref_list))
+                    e.insert(index, k)
+                    ref_list.insert(index, k)
+                elif ref_list:
+                    index = random.randrange(len(ref_list))
+                    if op == Operations.SET:
+                        e[index] = k
+                        ref_list[index] = k
+                    else:
+                        e.remove(index)
+                        del ref_list[index]
+                self.assertEqual(len(e), len(ref_list))
+
+            l = e.persistent()
+            self.assertEqual(l.tolist(), ref_list)
+            snapshots.append((l, list(ref_list)))
+
+        for l, ref_list in snapshots:
+            self.assertEqual(l.tolist(), ref_list)
+            self.assertEqual(len(l), len(ref_list))
+
     def test_iterator_empty(self):
         list = []
         pl = plist()
@@ -266,3 +408,85 @@ class TestPList(TestCase):
 
                 print("after: ", pl)
             self.assertEqual(l, pl.tolist())
+
+
+class TestTreePList(TestCase):
+
+    def test_init(self):
+        l = plist(engine=TREE_ENGINE)
+        self.assertEqual(len(l), 0)
+        self.assertEqual(l.tolist(), [])
+
+    def test_unknown_engine(self):
+        self.assertRaises(ValueError, partial(plist, engine='array'))
+
+    def test_append(self):
+        l = plist(engine=TREE_ENGINE)
+        l = l.append_back(1).append_back(2).append_front(0)
+        self.assertEqual(l.tolist(), [0, 1, 2])
+        self.assertEqual(l.front(), 0)
+        self.assertEqual(l.back(), 2)
+
+    def test_bad_index(self):
+        l = plist(engine=TREE_ENGINE)
+        self.assertRaises(AssertionError, partial(l.set, index=0, value=0))
+        self.assertRaises(AssertionError, partial(l.remove, index=0))
+        self.assertRaises(TypeError, partial(l.insert, index='0', value=0))
+
+    def test_undo_redo(self):
+        l = plist(engine=TREE_ENGINE)
+        l1 = l.append_back(1)
+        l2 = l1.insert(0, 2)
+        self.assertEqual(l2.undo().tolist(), [1])
+        self.assertEqual(l2.undo().redo().tolist(), [2, 1])
+        self.assertIsNone(l.undo())
+        self.assertIsNone(l2.redo())
+
+    def test_from_iterable(self):
+        l = plist(range(1000), engine=TREE_ENGINE)
+        self.assertEqual(l.tolist(), list(range(1000)))
+        self.assertEqual(l[999], 999)
+        self.assertEqual(len(l.undo()), 0)
+        self.assertEqual(l.insert(500, 'x')[500], 'x')
+
+    def test_persistence(self):
+        l = plist(engine=TREE_ENGINE).append_back_list(range(100))
+        l2 = l.set(50, -1).remove(0).insert(10, -2)
+        self.assertEqual(l.tolist(), list(range(100)))
+        self.assertEqual(len(l2), 100)
+        self.assertEqual(l2[50], -1)
+        self.assertEqual(l2[10], -2)
+
+    def test_brute_force(self):
+        for i in range(50):
+            pl = plist(engine=TREE_ENGINE)
+            l = []
+
+            for j in range(300):
+                op = TestPList.get_operation()
+                ind = random.randint(0, len(l) - 1) if l else 0
+                value = random.randint(0, 1000)
+
+                if op == Operations.REMOVE:
+                    if not l:
+                        continue
+                    pl = pl.remove(ind)
+                    del l[ind]
+                elif op == Operations.APPEND_BACK:
+                    pl = pl.append_back(value)
+                    l.append(value)
+                elif op == Operations.APPEND_FRONT:
+                    pl = pl.append_front(value)
+                    l.insert(0, value)
+                elif op == Operations.SET:
+                    if not l:
+                        continue
+                    pl = pl.set(ind, value)
+                    l[ind] = value
+                elif op == Operations.INSERT:
+                    pl = pl.insert(ind, value)
+                    l.insert(ind, value)
+
+                self.assertEqual(len(pl), len(l))
+            self.assertEqual(l, pl.tolist())
+            self.assertEqual([pl[k] for k in range(len(l))], l)
@@ -1,5 +1,6 @@
 from unittest import TestCase
 from src import pmap
+from src.pmap import PMap, _BitmapIndexedNode, _CollisionNode
 
 class TestPMap(TestCase):
 
@@ -16,6 +17,26 @@ class TestPMap(TestCase):
         m = pmap(a=2, b=4)
         self.assertEqual(len(m), 2)
 
+    def test_from_mapping(self):
+        m = pmap({1: 'a', (2, 3): 'b', None: 'c'})
+        self.assertEqual(len(m), 3)
+        self.assertEqual(m[(2, 3)], 'b')
+        self.assertEqual(m[None], 'c')
+
+    def test_keyword_named_initial(self):
+        self.assertEqual(dict(pmap(initial=1).iteritems()), {'initial': 1})
+        self.assertEqual(dict(pmap({'a': 1}, initial=2).iteritems()), {'a': 1, 'initial': 2})
+
+    def test_from_items(self):
+        m = pmap(((i, i * i) for i in range(20000)), x=1)
+        self.assertEqual(len(m), 20001)
+        self.assertEqual(m[150], 22500)
+        self.assertEqual(m['x'], 1)
+        self.assertEqual(len(m.undo()), 0)
+
+        # повторный ключ - последнее значение
+        self.assertEqual(dict(pmap([(1, 'a'), (1, 'b')]).iteritems()), {1: 'b'})
+
     def test_set_new(self):
         m = pmap()
 
@@ -62,3 +83,209 @@ class TestPMap(TestCase):
 
         for (k, v) in m.items():
             self.assertEqual(v, k)
+
+    def test_many_keys(self):
+        m = pmap()
+        for i in range(5000):
+            m = m.set(i, i * 2)
+
+        self.assertEqual(len(m), 5000)
+        for i in range(5000):
+            self.assertEqual(m[i], i * 2)
+
+        for i in range(0, 5000, 2):
+            m = m.remove(i)
+
+        self.assertEqual(len(m), 2500)
+        self.assertEqual(sorted(m.iterkeys()), list(range(1, 5000, 2)))
+
+    def test_hash_collisions(self):
+        keys = [CollidingKey(i) for i in range(10)]
+        m = pmap()
+        for i, k in enumerate(keys):
+            m = m.set(k, i)
+
+        self.assertEqual(len(m), 10)
+        for i, k in enumerate(keys):
+            self.assertEqual(m[k], i)
+
+        m = m.set(3, 'other')
+        m = m.remove(keys[0])
+        self.assertEqual(len(m), 10)
+        self.assertNotIn(keys[0], m)
+        self.assertEqual(m[3], 'other')
+        self.assertEqual(m[keys[9]], 9)
+
+    def test_remove_compacts_trie(self):
+        def count_nodes(node):
+            return 1 + sum(count_nodes(e) for e in node.array if type(e) is not tuple)
+
+        m = pmap((i, i) for i in range(5000))
+        for i in range(10, 5000):
+            m = m.remove(i)
+
+        self.assertEqual(dict(m.iteritems()), dict((i, i) for i in range(10)))
+        self.assertEqual(count_nodes(m._root), count_nodes(pmap((i, i) for i in range(10))._root))
+
+    def test_remove_collision_compacts(self):
+        m = pmap()
+        keys = [CollidingKey(i) for i in range(3)]
+        for k in keys:
+            m = m.set(k, k.value)
+        m = m.remove(keys[0]).remove(keys[1])
+        self.assertEqual(len(m), 1)
+        self.assertIs(type(m._root.array[0]), tuple)
+        self.assertEqual(m[keys[2]], 2)
+
+    def test_remove_lifts_collision_node(self):
+        # 35 совпадает с CollidingKey по первому куску хеша (3) - коллизия опускается ниже
+        a, b = CollidingKey(1), CollidingKey(2)
+        m = pmap({35: 0, a: 0, b: 0}).remove(35)
+        self.assertIs(type(m._root.array[0]), _CollisionNode)
+        self.assertEqual(dict(m.iteritems()), {a: 0, b: 0})
+
+        e = pmap().evolver()
+        e.set(35, 0).set(a, 0).set(b, 0).remove(35)
+        self.assertIs(type(e.persistent()._root.array[0]), _CollisionNode)
+
+    def test_evolver_remove_compacts(self):
+        e = pmap().evolver()
+        e.set(0, 'a')
+        e.set(32, 'b')
+        e.remove(32)
+        m = e.persistent()
+        self.assertEqual(m._root.array, [(0, 'a')])
+
+    def test_set_copies_only_path(self):
+        m = pmap((i, i) for i in range(100000))
+        for key in (-1, 100000, 'new', 50):
+            m2 = m.set(key, 0)
+
+            # новая версия разделяет с исходной все ноды кроме пути к ключу
+            node, node2 = m._root, m2._root
+            copied = 0
+            while node is not node2:
+                copied += 1
+                if node.bitmap != node2.bitmap:
+                    # ключ занял новый слот на этом уровне
+                    break
+                changed = [(a, b) for a, b in zip(node.array, node2.array) if a is not b]
+                self.assertLessEqual(len(changed), 1)
+                if not changed or type(changed[0][0]) is tuple or type(changed[0][1]) is tuple:
+                    break
+                node, node2 = changed[0]
+            self.assertLessEqual(copied, 64 // 5 + 1)
+
+    def test_remove_missing(self):
+        m = pmap(a=1)
+        with self.assertRaises(KeyError):
+            m.remove('b')
+
+    def test_persistence(self):
+        m1 = pmap(a=1, b=2)
+        m2 = m1.set('a', 3).remove('b')
+        self.assertEqual(m1['a'], 1)
+        self.assertEqual(m1['b'], 2)
+        self.assertEqual(m2['a'], 3)
+        self.assertNotIn('b', m2)
+
+    def test_evolver(self):
+        m = pmap(a=1)
+        e = m.evolver()
+        for i in range(100):
+            e[i] = i
+        e.remove('a')
+        m2 = e.persistent()
+
+        # после persistent evolver не должен менять отданную pmap
+        e[0] = 'changed'
+        self.assertEqual(m2[0], 0)
+        self.assertEqual(len(m2), 100)
+        self.assertEqual(m['a'], 1)
+        self.assertEqual(len(m), 1)
+
+    def test_eq(self):
+        items = [(i, str(i)) for i in range(3000)] + [(CollidingKey(i), i) for i in range(5)]
+        m = pmap(items)
+        m2 = pmap(reversed(items))
+        self.assertEqual(m, m2)
+        self.assertEqual(hash(m), hash(m2))
+
+        m3 = pmap(items + [('extra', 1)]).remove('extra')
+        for i in range(0, 3000, 3):
+            m3 = m3.remove(i).set(i, str(i))
+        self.assertEqual(m, m3)
+        self.assertNotEqual(m, m3.set(5, 'x'))
+        self.assertNotEqual(m, m3.remove(CollidingKey(2)))
+        self.assertNotEqual(m, {})
+
+    def test_eq_after_split_key_removed(self):
+        # 62 и CollidingKey совпадают по первому куску хеша: удаляем ключ, из-за которого
+        # коллизия ушла на уровень ниже
+        a, b = CollidingKey(1), CollidingKey(2)
+        m = pmap({62: 0, a: 0, b: 0}).remove(62)
+        m2 = pmap({a: 0, b: 0})
+        self.assertEqual(m, m2)
+        self.assertEqual(hash(m), hash(m2))
+        self.assertNotEqual(m, pmap({a: 0, b: 1}))
+
+        e = pmap().evolver()
+        e.set(0, 'a')
+        e.set(32, 'b')
+        e.remove(32)
+        self.assertEqual(e.persistent(), pmap({0: 'a'}))
+
+    def test_eq_different_shape(self):
+        # тот же набор пар в нодах разной формы сравнивается поиском
+        a, b = CollidingKey(1), CollidingKey(2)
+        nested = _BitmapIndexedNode(1 << 3, [_BitmapIndexedNode(1, [_CollisionNode(3, [(a, 0), (b, 0)])])])
+        m = PMap(2, nested)
+        self.assertEqual(m, pmap({a: 0, b: 0}))
+        self.assertEqual(pmap({b: 0, a: 0}), m)
+        self.assertNotEqual(m, pmap({a: 0, b: 1}))
+        self.assertNotEqual(m, pmap({a: 0, 3: 0}))
+
+    def test_hash_incremental(self):
+        m = pmap((i, i) for i in range(100))
+        hash(m)
+        m2 = m.set(1, 'a').set(200, 'b').remove(3).update({5: 'c'})
+        self.assertIsNotNone(m2._items_hash)
+        self.assertEqual(hash(m2), hash(pmap(m2.iteritems())))
+        self.assertEqual(hash(m2.set(1, 1).set(3, 3).set(5, 5).remove(200)), hash(m))
+
+    def test_undo_redo(self):
+        m = pmap(a=1)
+        m2 = m.set('b', 2)
+        self.assertEqual(len(m2.undo()), 1)
+        self.assertEqual(len(m2.redo()), 2)
+
+    def test_undo_redo_persistent(self):
+        m = pmap((i, i) for i in range(1000))
+        m2 = m.set('x', 1).remove(5)
+        m1 = m2.undo()
+        self.assertEqual(len(m1), 1001)
+        self.assertEqual(m1['x'], 1)
+        self.assertIn(5, m1)
+        # undo не меняет исходную версию
+        self.assertEqual(len(m2), 1000)
+        self.assertNotIn(5, m2)
+
+        self.assertEqual(len(m1.undo()), 1000)
+        self.assertNotIn('x', m1.undo())
+        self.assertEqual(len(m1.redo()), 1000)
+        self.assertNotIn(5, m1.redo())
+        self.assertIs(m2.redo(), m2)
+        empty = pmap()
+        self.assertIs(empty.undo(), empty)
+
+
+class CollidingKey(object):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __hash__(self):
+        return 3
+
+    def __eq__(self, other):
+        return isinstance(other, CollidingKey) and self.value == other.value
@@ -1,5 +1,9 @@
+from array import array
 from unittest import TestCase
-from src import pvector
+from src import pvector, VersionHistory
+from src.pvector import BRANCH_FACTOR
+import gc
+import random
 import pytest
 
 class TestPythonPVector(TestCase):
@@ -77,6 +81,32 @@ class TestPythonPVector(TestCase):
         v = v.append(4)
         self.assertEqual(v[-1], 4)
 
+    def test_get_item_focus(self):
+        init_list = list(range(100, 3100))
+        v = pvector(init_list)
+        self.assertEqual(v[40], 140)
+        self.assertEqual(v._focus[:2], (32, 64))
+        self.assertEqual([v[i] for i in range(len(v))], init_list)
+        self.assertEqual([v[-i] for i in range(1, len(v) + 1)], init_list[::-1])
+
+        # изменение не задевает фокус исходного вектора
+        v.set(3000 - 100, -1)
+        self.assertEqual(v[2900], 3000)
+        self.assertEqual(v.set(33, -1)[33], -1)
+        self.assertEqual(v[33], 133)
+
+        with self.assertRaises(IndexError):
+            v[len(v)]
+        with self.assertRaises(IndexError):
+            v[-len(v) - 1]
+
+    def test_get_item_focus_relaxed(self):
+        init_list = list(range(3000))
+        v = pvector(range(500))[7:100] + pvector(range(100, 3000))
+        ref = init_list[7:]
+        self.assertEqual([v[i] for i in range(len(v))], ref)
+        self.assertEqual([v[i] for i in range(len(v) - 1, -1, -1)], ref[::-1])
+
     def test_hash(self):
         v = pvector([4, 5, 6])
         self.assertEqual(hash(v), hash(v))
@@ -88,6 +118,58 @@ class TestPythonPVector(TestCase):
         for i, val in enumerate(v):
             self.assertEqual(v[i], val)
 
+    def test_iter_large(self):
+        init_list = list(range(2000))
+        v = pvector(init_list)
+        self.assertEqual(list(v), init_list)
+
+    def test_reversed(self):
+        init_list = list(range(1100))
+        v = pvector(init_list)
+        self.assertEqual(list(reversed(v)), init_list[::-1])
+
+    def test_index(self):
+        v = pvector(list(range(100)) * 2)
+        self.assertEqual(v.index(40), 40)
+        self.assertEqual(v.index(40, 41), 140)
+        with pytest.raises(ValueError):
+            v.index(40, 41, 100)
+        with pytest.raises(ValueError):
+            v.index(200)
+
+    def test_hash_as_tuple(self):
+        init_list = list(range(100)) + ['a', None]
+        self.assertEqual(hash(pvector(init_list)), hash(tuple(init_list)))
+
+    def test_hash_cached(self):
+        v = pvector(range(1000))
+        h = hash(v)
+        self.assertEqual(v._cached_hash, h)
+        self.assertEqual(hash(v.set(0, 0)), h)
+
+    def test_eq(self):
+        init_list = list(range(3000))
+        v = pvector(init_list)
+        # разная структура дерева: relaxed после конкатенации срезов
+        v2 = pvector(range(500))[:100] + pvector(range(100, 3000))
+        self.assertEqual(v, v2)
+        self.assertEqual(v, init_list)
+        self.assertFalse(v != v2)
+        self.assertNotEqual(v, v2.set(2999, -1))
+        self.assertNotEqual(v, v2.append(1))
+        self.assertNotEqual(v, tuple(init_list))
+        self.assertEqual(v.set(5, 'x'), v.set(5, 'x'))
+        self.assertEqual(len(set([v, v2, v.set(0, 0)])), 1)
+
+    def test_ordering(self):
+        self.assertLess(pvector([1, 2]), pvector([1, 3]))
+        self.assertLess(pvector([1, 2]), pvector([1, 2, 0]))
+        self.assertGreaterEqual(pvector([2]), [1, 5])
+        self.assertLessEqual(pvector(), pvector())
+
+    def test_str(self):
+        self.assertEqual(str(pvector([1, 'a'])), str([1, 'a']))
+
     # test slice
     def test_pos_slice(self):
         v = pvector([1, 2, 3, 4])
@@ -107,6 +189,224 @@ class TestPythonPVector(TestCase):
         v = pvector(init_list)
         self.assertEqual(v[1:3].tolist(), [2, 3])
 
+    def test_step_slice(self):
+        init_list = list(range(100))
+        v = pvector(init_list)
+        self.assertEqual(v[::3].tolist(), init_list[::3])
+        self.assertEqual(v[::-1].tolist(), init_list[::-1])
+
+    def test_empty_slice(self):
+        v = pvector([1, 2, 3, 4])
+        self.assertEqual(v[3:1].tolist(), [])
+        self.assertEqual(v[10:].tolist(), [])
+
+    def test_large_slice(self):
+        init_list = list(range(5000))
+        v = pvector(init_list)
+        for start, stop in [(0, 1056), (7, 4000), (1000, 1033), (4990, 5000), (33, 34), (31, 4999)]:
+            self.assertEqual(v[start:stop].tolist(), init_list[start:stop])
+            self.assertEqual(v[start:stop][5:-5].tolist(), init_list[start:stop][5:-5])
+
+    def test_slice_shares_leaves(self):
+        v = pvector(range(5000))
+        v2 = v[100:4000]
+        leaves = set(map(id, v._iter_leaves()))
+        shared = [leaf for leaf in v2._iter_leaves() if id(leaf) in leaves]
+        self.assertGreater(len(shared), 100)
+
+    def test_slice_modify(self):
+        init_list = list(range(3000))
+        v = pvector(init_list)[45:2500]
+        ref = init_list[45:2500]
+        for i in range(0, len(ref), 37):
+            v = v.set(i, -i)
+            ref[i] = -i
+        for i in range(2000):
+            v = v.append(i)
+            ref.append(i)
+        self.assertEqual(v.tolist(), ref)
+        self.assertEqual([v[i] for i in range(len(ref))], ref)
+
+        e = v.evolver()
+        for i in range(0, len(ref), 13):
+            e[i] = i
+            ref[i] = i
+        self.assertEqual(e.persistent().tolist(), ref)
+
+    def test_typed(self):
+        data = [i / 2 for i in range(5000)]
+        v = pvector(data, typecode='d')
+        self.assertEqual(v.typecode, 'd')
+        self.assertIsNone(pvector(data).typecode)
+        self.assertEqual(v.tolist(), data)
+        self.assertEqual(v, pvector(data))
+        self.assertEqual(hash(v), hash(tuple(data)))
+        self.assertTrue(all(type(leaf) is array for leaf in v._iter_leaves()))
+
+        v2 = v.set(10, -1.0).append(7.0).insert(100, 3.0).delete(0)[5:4000]
+        ref = list(data)
+        ref[10] = -1.0
+        ref.append(7.0)
+        ref.insert(100, 3.0)
+        del ref[0]
+        self.assertEqual(v2.tolist(), ref[5:4000])
+        self.assertEqual(v2.typecode, 'd')
+        self.assertTrue(all(type(leaf) is array for leaf in v2._iter_leaves()))
+
+        e = v2.evolver()
+        e[0] = 1.0
+        e.extend([2.0] * 100)
+        self.assertEqual(e.persistent().typecode, 'd')
+
+    def test_typed_bad_value(self):
+        v = pvector([1, 2, 3], typecode='i')
+        with self.assertRaises(TypeError):
+            v.set(0, 'a')
+        with self.assertRaises(TypeError):
+            v.append(1.5)
+
+    def test_typed_extend_array(self):
+        self.assertEqual(pvector(array('i', [1, 2]), typecode='d').tolist(), [1.0, 2.0])
+        v = pvector([1.0], typecode='d').extend(array('f', [0.5] * 40))
+        self.assertEqual(v.typecode, 'd')
+        self.assertEqual(v.tolist(), [1.0] + [0.5] * 40)
+        self.assertEqual(pvector(['x']).extend(array('i', range(40))).tolist(), ['x'] + list(range(40)))
+        with self.assertRaises(TypeError):
+            pvector(typecode='i').extend(array('d', [1.5]))
+
+    def test_typed_concat(self):
+        typed = pvector([1.5] * 40, typecode='d')
+        strings = pvector(['x'] * 40)
+
+        v = strings + typed
+        self.assertIsNone(v.typecode)
+        self.assertTrue(all(type(leaf) is list for leaf in v._iter_leaves()))
+        self.assertEqual(v.append('z').tolist(), ['x'] * 40 + [1.5] * 40 + ['z'])
+
+        v = typed + pvector(range(40))
+        self.assertEqual(v.typecode, 'd')
+        self.assertTrue(all(type(leaf) is array for leaf in v._iter_leaves()))
+        self.assertEqual(v.tolist(), [1.5] * 40 + [float(i) for i in range(40)])
+        self.assertEqual(pvector(typecode='d').extend(pvector([1, 2])).typecode, 'd')
+        self.assertEqual((typed + pvector([2.5], typecode='f')).tolist(), [1.5] * 40 + [2.5])
+
+        with self.assertRaises(TypeError):
+            typed + strings
+
+    def test_take(self):
+        data = list(range(5000))
+        v = pvector(data)[3:]
+        indices = [0, 1, 2, 40, 41, 4996, -1, 1000, 999, 0]
+        taken = v.take(indices)
+        self.assertEqual(taken.tolist(), [data[3:][i] for i in indices])
+        self.assertEqual(v.take([]).tolist(), [])
+        self.assertEqual(pvector([1.5, 2.5], typecode='d').take([1]).typecode, 'd')
+
+        with self.assertRaises(IndexError):
+            v.take([5000])
+
+    def test_from_numpy(self):
+        numpy = pytest.importorskip('numpy')
+        from src import from_numpy
+
+        for n in (0, 5, 32, 1056, 40000):
+            arr = numpy.arange(n, dtype=numpy.float64) / 3
+            v = from_numpy(arr)
+            self.assertEqual(v.typecode, 'd')
+            self.assertEqual(v.tolist(), arr.tolist())
+            self.assertEqual(v, pvector(arr.tolist()))
+            self.assertTrue((v.to_numpy() == arr).all())
+            self.assertEqual(v.to_numpy().dtype, arr.dtype)
+
+        v = from_numpy(numpy.arange(100, dtype=numpy.int64))
+        self.assertEqual(v.append(100)[100], 100)
+        self.assertEqual(len(v.undo()), 0)
+        self.assertEqual(from_numpy(numpy.array(['a', 'b'], dtype=object)).tolist(), ['a', 'b'])
+
+        with self.assertRaises(ValueError):
+            from_numpy(numpy.zeros((2, 2)))
+
+    def test_to_numpy(self):
+        numpy = pytest.importorskip('numpy')
+        v = pvector(range(3000))[10:] + pvector(range(50))
+        arr = v.to_numpy(dtype=numpy.int64)
+        self.assertEqual(arr.tolist(), v.tolist())
+        self.assertEqual(v.take(numpy.array([0, 5, -1])).tolist(), [10, 15, 49])
+
+    def test_extend_bottom_up(self):
+        for n in (0, 31, 32, 1024, 1056, 32 * 1024, 32 * 1024 + 5):
+            v = pvector(range(n))
+            for m in (1, 32, 33, 2000, 40000):
+                ref = list(range(n)) + list(range(m))
+                w = v.extend(range(m))
+                self.assertEqual(w.tolist(), ref)
+                self.assertEqual([w[i] for i in range(0, len(ref), 97)], ref[::97])
+                # то же плотное дерево, что и при поэлементном заполнении
+                self.assertIs(type(w._root), list)
+                self.assertEqual(len(w._tail), len(ref) % 32)
+                self.assertEqual(w.append(-1)[len(ref)], -1)
+
+        v = pvector(range(32 * 1024)).extend(range(32))
+        self.assertEqual(v._shift, 15)
+        self.assertEqual(len(v._root), 2)
+
+    def test_extend_relaxed(self):
+        v = pvector(range(1000))[5:]
+        w = v.extend(range(5000))
+        self.assertEqual(w.tolist(), list(range(5, 1000)) + list(range(5000)))
+        self.assertEqual(v.tolist(), list(range(5, 1000)))
+
+    def test_concat(self):
+        left = pvector(range(1000))[7:]
+        right = pvector(range(5000))[33:4100]
+        v = left + right
+        self.assertEqual(v.tolist(), list(range(7, 1000)) + list(range(33, 4100)))
+        self.assertEqual(v[993], 33)
+        self.assertEqual(left.tolist(), list(range(7, 1000)))
+
+        v = v.append(-1).set(500, -2)
+        self.assertEqual(v[-1], -1)
+        self.assertEqual(v[500], -2)
+
+    def test_concat_dense(self):
+        v = pvector(range(1024)).concat(pvector(range(2048)))
+        self.assertEqual(v.tolist(), list(range(1024)) + list(range(2048)))
+        self.assertIs(type(v._root), list)
+
+    def test_insert(self):
+        ref = list(range(3000))
+        v = pvector(ref)
+        for i in (0, 1500, 2999, 3002, -1, -5000, 10000, 1234):
+            v = v.insert(i, 'x')
+            ref.insert(i, 'x')
+        self.assertEqual(v.tolist(), ref)
+        self.assertEqual(len(v), len(ref))
+
+    def test_delete(self):
+        ref = list(range(3000))
+        v = pvector(ref)
+        for i in (0, 1500, -1, 2000, -100, 31, 32):
+            v = v.delete(i)
+            del ref[i]
+        self.assertEqual(v.tolist(), ref)
+
+        with self.assertRaises(IndexError):
+            v.delete(len(ref))
+
+    def test_insert_delete_many(self):
+        ref = []
+        v = pvector()
+        for i in range(3000):
+            pos = (i * 7919) % (len(ref) + 1)
+            v = v.insert(pos, i)
+            ref.insert(pos, i)
+        for i in range(1000):
+            pos = (i * 104729) % len(ref)
+            v = v.delete(pos)
+            del ref[pos]
+        self.assertEqual(v.tolist(), ref)
+        self.assertEqual([v[i] for i in range(len(ref))], ref)
+
     # test set
     def test_set_one(self):
         v = pvector()
@@ -136,6 +436,80 @@ class TestPythonPVector(TestCase):
         v1 = v.remove(3)
         self.assertEqual(len(v1), 0)
 
+    def test_mset(self):
+        v = pvector(range(5000))
+        v2 = v.mset(0, 'a', 4999, 'b', -2, 'c', 1000, 'd', 1001, 'e', 0, 'f')
+        ref = list(range(5000))
+        ref[0], ref[4999], ref[4998], ref[1000], ref[1001] = 'f', 'b', 'c', 'd', 'e'
+        self.assertEqual(v2.tolist(), ref)
+        self.assertEqual(v.tolist(), list(range(5000)))
+
+        with self.assertRaises(TypeError):
+            v.mset(1)
+        with self.assertRaises(IndexError):
+            v.mset(5000, 1)
+
+    def test_set_many(self):
+        ref = list(range(40000))
+        v = pvector(ref)[17:]
+        ref = ref[17:]
+        updates = dict((i, -i) for i in range(0, len(ref), 7))
+        for i, val in updates.items():
+            ref[i] = val
+
+        versions = len(v.versions())
+        v2 = v.set_many(updates)
+        self.assertEqual(v2.tolist(), ref)
+        self.assertEqual(len(v.versions()), versions + 1)
+        self.assertEqual(v.set_many([(3, 'x')])[3], 'x')
+
+    def test_set_many_copies_path_once(self):
+        v = pvector(range(2000))
+        v2 = v.set_many({0: 'a', 1: 'b', 31: 'c'})
+        self.assertIsNot(v2._root[0], v._root[0])
+        self.assertIs(v2._root[1], v._root[1])
+        self.assertEqual(v2[:32].tolist(), ['a', 'b'] + list(range(2, 31)) + ['c'])
+
+    def test_put(self):
+        v = pvector(range(100))
+        v2 = v.put([5, 50, -1], ['a', 'b', 'c'])
+        self.assertEqual((v2[5], v2[50], v2[99]), ('a', 'b', 'c'))
+
+        with self.assertRaises(ValueError):
+            v.put([1, 2], [1])
+
+    def test_remove_large(self):
+        v = pvector(range(100000))
+        v1 = v.remove(99990)
+        self.assertEqual(len(v1), 99999)
+        self.assertEqual(v1[99989], 99989)
+        self.assertEqual(v1[99990], 99991)
+        self.assertEqual(v1.tolist(), list(range(99990)) + list(range(99991, 100000)))
+
+        # изменился только путь к листу с удаленным элементом
+        leaves = set(map(id, v._iter_leaves()))
+        shared = [leaf for leaf in v1._iter_leaves() if id(leaf) in leaves]
+        self.assertGreater(len(shared), 3000)
+
+    def test_remove_missing(self):
+        with self.assertRaises(ValueError):
+            pvector([1, 2]).remove(3)
+
+    def test_remove_one_version(self):
+        v = pvector(range(100))
+        versions = len(v.versions())
+        v.remove(50)
+        self.assertEqual(len(v.versions()), versions + 1)
+
+    def test_pop(self):
+        v = pvector(range(100))
+        self.assertEqual(v.pop().tolist(), list(range(99)))
+        self.assertEqual(v.pop(0).tolist(), list(range(1, 100)))
+        self.assertEqual(pvector(range(33)).pop().tolist(), list(range(32)))
+
+        with self.assertRaises(IndexError):
+            pvector().pop()
+
     def test_undo_one(self):
         v = pvector([3, 4, 5])
 
@@ -167,4 +541,332 @@ class TestPythonPVector(TestCase):
         v = v.set(0, 45)
         self.assertEqual(v[0], 45)
 
+    # test history
+    def test_history_unbounded(self):
+        v = pvector()
+        for i in range(10):
+            v = v.append(i)
+        self.assertEqual(len(v.versions()), 11)
+        self.assertEqual(v.undo().tolist(), list(range(9)))
+
+    def test_history_last(self):
+        v = pvector(history=VersionHistory(VersionHistory.LAST, max_versions=3))
+        for i in range(10):
+            v = v.append(i)
 
+        self.assertEqual(len(v.versions()), 3)
+        v1 = v.undo()
+        v2 = v1.undo()
+        self.assertEqual(v1.tolist(), list(range(9)))
+        self.assertEqual(v2.tolist(), list(range(8)))
+        # за пределами окна undo остается на месте
+        self.assertIs(v2.undo(), v2)
+        self.assertIs(v2.redo(), v1)
+
+    def test_history_weak(self):
+        v = pvector(history=VersionHistory(VersionHistory.WEAK))
+        for i in range(100):
+            v = v.append(i)
+        gc.collect()
+
+        self.assertEqual(v.versions(), [v])
+        v2 = v.append(100)
+        self.assertIs(v2.undo(), v)
+        self.assertIs(v.redo(), v2)
+
+    def test_history_weak_skips_dead(self):
+        history = VersionHistory(VersionHistory.WEAK)
+        first = pvector([0], history=history)
+        kept = [first]
+        v = first
+        for i in range(5000):
+            v = v.append(i)
+            if i % 1000 == 999:
+                kept.append(v)
+        gc.collect()
+
+        # умершие версии выпали из списка живых - undo/redo переходят к соседней живой
+        self.assertIs(kept[-1].undo(), kept[-2])
+        self.assertIs(kept[1].undo(), first)
+        self.assertIs(first.redo(), kept[1])
+        self.assertIs(kept[-1].redo(), kept[-1])
+
+        del kept[2]
+        gc.collect()
+        self.assertIs(kept[2].undo(), kept[1])
+        self.assertIs(kept[1].redo(), kept[2])
+        self.assertIs(kept[2].append(1).undo(), kept[-1])
+
+    def test_history_off(self):
+        v = pvector([1, 2], history=VersionHistory(VersionHistory.OFF))
+        v2 = v.append(3)
+        self.assertEqual(v2.versions(), [])
+        self.assertIs(v2.undo(), v2)
+        self.assertIs(v2.redo(), v2)
+
+    def test_history_bad_policy(self):
+        with pytest.raises(ValueError):
+            VersionHistory('forever')
+        with pytest.raises(ValueError):
+            VersionHistory(VersionHistory.LAST)
+
+    def test_slice_single_version(self):
+        v = pvector([1, 2, 3, 4])
+        versions = len(v.versions())
+        v[1:3]
+        v.remove(2)
+        self.assertEqual(len(v.versions()), versions + 2)
+
+    def test_checkout(self):
+        v = pvector()
+        ids = []
+        for i in range(5):
+            v = v.append(i)
+            ids.append(v.version_id)
+
+        self.assertEqual(v.checkout(ids[1]).tolist(), [0, 1])
+        self.assertIs(v.checkout(ids[-1]), v)
+        with pytest.raises(KeyError):
+            v.checkout(100)
+
+    def test_checkout_evicted(self):
+        v = pvector(history=VersionHistory(VersionHistory.LAST, max_versions=2))
+        first_id = v.version_id
+        for i in range(5):
+            v = v.append(i)
+        with pytest.raises(KeyError):
+            v.checkout(first_id)
+
+    def test_undo_redo_long_history(self):
+        v = pvector()
+        for i in range(1000):
+            v = v.append(i)
+
+        for i in range(1000):
+            v = v.undo()
+        self.assertEqual(len(v), 0)
+
+        for i in range(1000):
+            v = v.redo()
+        self.assertEqual(len(v), 1000)
+
+    def test_iterate_while_appending(self):
+        v = pvector(range(40))
+        it = iter(v)
+        v.append(7)
+        self.assertEqual(list(it), list(range(40)))
+
+        v = pvector([1, 2, 3])
+        it = reversed(v)
+        v.append(9)
+        self.assertEqual(list(it), [3, 2, 1])
+
+        # дописывание в обходимый вектор не удлиняет обход
+        acc = v
+        for x in v:
+            acc = acc.append(x)
+        self.assertEqual(acc.tolist(), [1, 2, 3, 1, 2, 3])
+
+    def test_append_shares_tail(self):
+        v = pvector([1, 2])
+        v1 = v.append(3)
+        v2 = v1.append(4)
+        self.assertIs(v2._tail, v._tail)
+
+        # буфер уже продолжен - ветка от v копирует свой префикс
+        w = v.append(5)
+        self.assertIsNot(w._tail, v._tail)
+        self.assertEqual(w.tolist(), [1, 2, 5])
+        self.assertEqual(w.append(6).tolist(), [1, 2, 5, 6])
+
+    def test_append_branches(self):
+        base = pvector(range(40))
+        branches = [base.append(i) for i in range(10)]
+        branches = [b.append(-1).set(41, -2) for b in branches]
+
+        self.assertEqual(base.tolist(), list(range(40)))
+        self.assertEqual(list(reversed(base)), list(range(39, -1, -1)))
+        self.assertEqual(base, pvector(range(40)))
+        for i, b in enumerate(branches):
+            self.assertEqual(b.tolist(), list(range(40)) + [i, -2])
+        self.assertEqual((base + base).tolist(), list(range(40)) * 2)
+        self.assertEqual(base.insert(40, 'x')[40:], pvector(['x']))
+        self.assertEqual(base.delete(39).tolist(), list(range(39)))
+
+    def test_append_branches_typed(self):
+        base = pvector([1.5, 2.5], typecode='d')
+        v1 = base.append(3.5)
+        v2 = base.append(4.5)
+        self.assertIs(v1._tail, base._tail)
+        self.assertEqual(base.tolist(), [1.5, 2.5])
+        self.assertEqual(v1.tolist(), [1.5, 2.5, 3.5])
+        self.assertEqual(v2.tolist(), [1.5, 2.5, 4.5])
+
+    def test_append_in_place_coerced(self):
+        # значения, которые array хранит приведенными, тоже дописываются на месте
+        for typecode, values in (('f', [0.1, 0.2, 1e-3]), ('d', [float('nan'), 2 ** 53 + 1])):
+            base = pvector(typecode=typecode)
+            v = base
+            for val in values:
+                v = v.append(val)
+                self.assertIs(v._tail, base._tail)
+            self.assertEqual(len(v), len(values))
+            self.assertEqual(len(v._tail), len(values))
+
+    def test_append_race_loser_write(self):
+        # проигравший гонку поток успевает дописать свой элемент в общий буфер до проверки
+        # владения - в дерево и в обходы он попадать не должен
+        for base in (pvector(range(63)), pvector(range(10))[:5] + pvector(range(5, 100))):
+            n = len(base)
+            ref = list(range(n)) + ['a', 'b']
+            a = base.append('a')
+            base._tail.append('x')
+            self.assertEqual(len(a._tail), BRANCH_FACTOR + 1)
+
+            # полный хвост a уходит в дерево
+            b = a.append('b')
+            self.assertEqual(len(b), n + 2)
+            self.assertEqual(b.tolist(), ref)
+            self.assertEqual(list(b), ref)
+            self.assertEqual(list(reversed(b)), ref[::-1])
+            self.assertTrue(all(len(leaf) <= BRANCH_FACTOR for leaf in b._iter_leaves()))
+            self.assertEqual(b[n], 'a')
+
+            self.assertEqual((a + pvector(range(40))).tolist(), ref[:-1] + list(range(40)))
+            self.assertEqual(a.set_many({0: -1}).append('b').tolist(), [-1] + ref[1:])
+
+            e = a.evolver()
+            e.append('b')
+            self.assertEqual(e.persistent().tolist(), ref)
+
+    def test_evolver_on_shared_tail(self):
+        v = pvector([1, 2])
+        v.append(3)
+        e = v.evolver()
+        e.append(4)
+        e[0] = 0
+        self.assertEqual(e.persistent().tolist(), [0, 2, 4])
+        self.assertEqual(v.tolist(), [1, 2])
+
+
+class TestEvolver(TestCase):
+    """ Случайные последовательности операций evolver'а сверяются с list """
+
+    def _check(self, e, ref):
+        self.assertEqual(len(e), len(ref))
+        for i in range(0, len(ref), max(1, len(ref) // 50)):
+            self.assertEqual(e[i], ref[i])
+
+    def _random_ops(self, seed, size, steps):
+        rnd = random.Random(seed)
+        ref = list(range(size))
+        e = pvector(ref).evolver()
+        snapshots = []
+
+        for step in range(steps):
+            op = rnd.randrange(11)
+            n = len(ref)
+            if op == 0 and n:
+                i = rnd.randrange(-n, n)
+                e[i] = ref[i] = ('set', step)
+            elif op == 1:
+                e.append(step)
+                ref.append(step)
+            elif op == 2:
+                values = list(range(rnd.randrange(100)))
+                e.extend(values)
+                ref.extend(values)
+            elif op == 3:
+                i = rnd.randint(-n - 3, n + 3)
+                e.insert(i, ('insert', step))
+                ref.insert(i, ('insert', step))
+            elif op == 4 and n:
+                i = rnd.randrange(-n, n)
+                del e[i]
+                del ref[i]
+            elif op == 5 and n:
+                i = rnd.randrange(-n, n)
+                self.assertEqual(e.pop(i), ref.pop(i))
+            elif op == 6 and n:
+                a, b = sorted(rnd.randint(0, n) for _ in range(2))
+                self.assertEqual(e[a:b].tolist(), ref[a:b])
+            elif op == 7 and n:
+                a, b = sorted(rnd.randint(0, n) for _ in range(2))
+                del e[a:b]
+                del ref[a:b]
+            elif op == 8:
+                a, b = sorted(rnd.randint(0, n) for _ in range(2))
+                values = [('slice', step)] * rnd.randrange(70)
+                e[a:b] = values
+                ref[a:b] = values
+            elif op == 9 and n:
+                step_size = rnd.randint(2, 5)
+                del e[::step_size]
+                del ref[::step_size]
+            else:
+                v = e.persistent()
+                self.assertEqual(v.tolist(), ref)
+                snapshots.append((v, list(ref)))
+
+            self._check(e, ref)
+
+        self.assertEqual(e.persistent().tolist(), ref)
+        # evolver не меняет уже отданные векторы
+        for v, expected in snapshots:
+            self.assertEqual(v.tolist(), expected)
+
+    def test_random_small(self):
+        for seed in range(20):
+            self._random_ops(seed, 10, 150)
+
+    def test_random_large(self):
+        for seed in range(4):
+            self._random_ops(seed, 3000, 300)
+
+    def test_set_in_place(self):
+        v = pvector(range(1000))
+        e = v.evolver()
+        for i in range(1000):
+            e[i] = -i
+        self.assertEqual(e.persistent().tolist(), [-i for i in range(1000)])
+        self.assertEqual(v.tolist(), list(range(1000)))
+
+    def test_persistent_not_dirty(self):
+        v = pvector(range(100))
+        e = v.evolver()
+        self.assertFalse(e.is_dirty())
+        self.assertIs(e.persistent(), v)
+
+        e.append(1)
+        self.assertTrue(e.is_dirty())
+        v2 = e.persistent()
+        self.assertFalse(e.is_dirty())
+        self.assertIs(e.persistent(), v2)
+
+    def test_persistent_shares_tail(self):
+        e = pvector(range(40)).evolver()
+        e.append(40)
+        v = e.persistent()
+        self.assertIs(v._tail, e._tail)
+
+        # после persistent хвост копируется при записи
+        e.append(41)
+        e[35] = 'x'
+        self.assertEqual(v.tolist(), list(range(41)))
+        self.assertEqual(e.persistent().tolist(), list(range(35)) + ['x'] + list(range(36, 42)))
+
+    def test_pop_empty(self):
+        with self.assertRaises(IndexError):
+            pvector().evolver().pop()
+
+    def test_extended_slice_size(self):
+        e = pvector(range(10)).evolver()
+        with self.assertRaises(ValueError):
+            e[::2] = [1, 2]
+
+    def test_remove(self):
+        e = pvector([1, 2, 3, 2]).evolver()
+        e.remove(2)
+        self.assertEqual(e.persistent().tolist(), [1, 3, 2])
+        with self.assertRaises(ValueError):
+            e.remove(5)